@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import networkx as nx
 
+from beta_dia import seqid
 from beta_dia.log import Logger
 
 try:
@@ -59,20 +60,27 @@ def greedy_bipartite_vertex_cover(graph):
     return protein_v, peptide_v
 
 
-def assemble_to_pg(df_input, q_cut_infer, run_or_global):
+def assemble_to_pg(df_input, q_cut_infer, run_or_global, is_seq_out=True):
+    '''
+    Protein groups by the IDPicker cover of peptides (strip seqs). The
+    strip_seq (and simple_seq) columns are output if is_seq_out, trial runs
+    that only count groups skip the strings.
+    '''
     col_q_pr = 'q_pr_' + run_or_global
     col_cscore_pr = 'cscore_pr_' + run_or_global
 
-    if 'strip_seq' not in df_input.columns:
+    # strip_seq is output as before, the inference is on its ids
+    if is_seq_out and 'strip_seq' not in df_input.columns:
+        simple_seq, strip_seq = seqid.get_seqs(df_input['pr_id'])
         if 'simple_seq' not in df_input.columns:
-            df_input['simple_seq'] = df_input['pr_id'].str[:-1].replace(
-                ['C\(UniMod:4\)', 'M\(UniMod:35\)'], ['c', 'm'], regex=True
-            )
-        df_input['strip_seq'] = df_input['simple_seq'].str.upper()
+            df_input['simple_seq'] = simple_seq
+        df_input['strip_seq'] = strip_seq
+    is_id_input = 'strip_id' in df_input.columns
+    df_input['strip_id'] = seqid.get_seq_ids(df_input, 'strip_id')
 
     df = df_input[df_input[col_q_pr] < q_cut_infer]
 
-    df = df[['protein_id', 'strip_seq', col_cscore_pr]]
+    df = df[['protein_id', 'strip_id', col_cscore_pr]]
     df['protein_id'] = df['protein_id'].str.split(';')
     proteins = df['protein_id'].explode().values
     protein_num = df['protein_id'].apply(len)
@@ -82,10 +90,10 @@ def assemble_to_pg(df_input, q_cut_infer, run_or_global):
     df['protein_id'] = proteins
 
     # protein meta
-    df_protein = df.groupby('protein_id', sort=False)['strip_seq'].agg(set)
+    df_protein = df.groupby('protein_id', sort=False)['strip_id'].agg(set)
     df_protein = df_protein.reset_index()
-    df_protein['strip_seq'] = df_protein['strip_seq'].apply(tuple)
-    df_protein = df_protein.groupby('strip_seq', sort=False)[
+    df_protein['strip_id'] = df_protein['strip_id'].apply(tuple)
+    df_protein = df_protein.groupby('strip_id', sort=False)[
         'protein_id'].agg(set)
     df_protein = df_protein.reset_index()
 
@@ -103,7 +111,7 @@ def assemble_to_pg(df_input, q_cut_infer, run_or_global):
     # from 1 vs. 1 to meta vs. meta
     df['Protein.Meta'] = df_protein.loc[df['protein_id']][
         'Protein.Meta'].values
-    df['Peptide.Meta'] = df['strip_seq'] # no need to make peptide.meta
+    df['Peptide.Meta'] = df['strip_id'] # no need to make peptide.meta
     df = df[['Protein.Meta', 'Peptide.Meta', col_cscore_pr]]
     df = df.sort_values(col_cscore_pr, ascending=False)
     df = df.drop_duplicates(
@@ -129,15 +137,17 @@ def assemble_to_pg(df_input, q_cut_infer, run_or_global):
         protein_v.extend(proteins)
         peptide_v.extend(peptides)
 
-    df = pd.DataFrame({'strip_seq': peptide_v, 'protein_group': protein_v})
-    pep_num = df['strip_seq'].apply(len).values
-    peptide_v = df['strip_seq'].explode().tolist()
+    df = pd.DataFrame({'strip_id': peptide_v, 'protein_group': protein_v})
+    pep_num = df['strip_id'].apply(len).values
+    peptide_v = df['strip_id'].explode().tolist()
     df = df.loc[np.repeat(df.index, pep_num)]
     df = df.reset_index(drop=True)
-    df['strip_seq'] = peptide_v
+    df['strip_id'] = peptide_v
 
     # result
-    df = df_input.merge(df, on='strip_seq', how='left').reset_index(drop=True)
+    df = df_input.merge(df, on='strip_id', how='left').reset_index(drop=True)
+    if not is_id_input:
+        del df['strip_id']
     not_in_range = df['protein_group'].isna()
     df.loc[not_in_range, 'protein_group'] = df.loc[not_in_range, 'protein_id']
     return df
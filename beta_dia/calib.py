@@ -1,7 +1,7 @@
+import bisect
 import warnings
 
 import matplotlib.pyplot as plt
-import networkx as nx
 import numpy as np
 import pandas as pd
 import statsmodels.api as sm
@@ -136,11 +136,14 @@ def update_info_im(df_tol, df_lib):
     y_measure, bias_before = y_measure[idx], bias_before[idx]
 
     # lowess
-    lowess = sm.nonparametric.lowess
     frac = 0.1
-    y_lowess = lowess(y_measure, x, frac=frac)
-    x_fit, y_fit = zip(*y_lowess)
-    x_fit, y_fit = np.array(x_fit), np.array(y_fit)
+    if param_g.is_calib_sample:
+        x_fit, y_fit = fit_by_sample(x, y_measure, frac)
+    else:
+        lowess = sm.nonparametric.lowess
+        y_lowess = lowess(y_measure, x, frac=frac)
+        x_fit, y_fit = zip(*y_lowess)
+        x_fit, y_fit = np.array(x_fit), np.array(y_fit)
     f = interp1d(x_fit, y_fit, kind='cubic', fill_value='extrapolate')
 
     # 3σ
@@ -207,11 +210,14 @@ def update_info_mz(df_seed, ms):
     y = y[idx]
     bias_old = (x - y) * 1000000. / y
 
-    lowess = sm.nonparametric.lowess
     frac = 0.1
-    y_lowess = lowess(y, x, frac=frac)
-    x_fit, y_fit = zip(*y_lowess)
-    x_fit, y_fit = np.array(x_fit), np.array(y_fit)
+    if param_g.is_calib_sample:
+        x_fit, y_fit = fit_by_sample(x, y, frac)
+    else:
+        lowess = sm.nonparametric.lowess
+        y_lowess = lowess(y, x, frac=frac)
+        x_fit, y_fit = zip(*y_lowess)
+        x_fit, y_fit = np.array(x_fit), np.array(y_fit)
 
     f = interp1d(x_fit, y_fit, kind='cubic', fill_value='extrapolate')
 
@@ -239,6 +245,10 @@ def update_info_mz(df_seed, ms):
                     fname='update_info_mz')
 
     # update
+    if param_g.is_mz_calib_lazy:
+        ms.set_mz_correction(f)
+        return df_seed
+
     for swath_id in range(len(ms.get_swath())):
         if swath_id == 0:
             continue
@@ -293,23 +303,73 @@ def screen_by_hist(x_data, y_data, bins):
     return x_hist, y_hist, cell_counts
 
 
+def range_reduce(v, lo, hi, func):
+    '''
+    func (np.minimum or np.maximum) of v[lo:hi + 1] for each pair of lo/hi
+    by a sparse table.
+    '''
+    table = [v]
+    k = 1
+    while 2 * k <= len(v):
+        x = table[-1]
+        table.append(func(x[:-k], x[k:]))
+        k *= 2
+    table = np.stack([np.pad(x, (0, len(v) - len(x)), mode='edge')
+                      for x in table])
+    j = np.floor(np.log2(hi - lo + 1)).astype(np.int64)
+    return func(table[j, lo], table[j, hi - 2 ** j + 1])
+
+
 def screen_by_graph(x_screen1, y_screen1):
-    # find the longest length path
-    G = nx.DiGraph()
-    for i in range(len(x_screen1)):
-        x_curr, y_curr = x_screen1[i], y_screen1[i]
-        candidates_idx = (x_screen1 >= x_curr) & (y_screen1 >= y_curr)
-        candidates_idx[i] = False # no self-cycle
-        x_candidates = x_screen1[candidates_idx]
-        y_candidates = y_screen1[candidates_idx]
-        candidates = [((x_curr, y_curr), (x, y)) for x, y in
-                      zip(x_candidates, y_candidates)]
-        G.add_edges_from(candidates)
-
-    # maybe exist multiple longest paths
-    longest_path = nx.dag_longest_path(G)
-    x_screen2, y_screen2 = zip(*longest_path)
-    x_screen2, y_screen2 = np.array(x_screen2), np.array(y_screen2)
+    '''
+    The longest path of the DAG where points link to the points dominating
+    them (x and y not smaller). It is a longest non-decreasing chain, so it
+    is found in O(n log n) without the O(n^2) edges. Ties are broken as by
+    nx.dag_longest_path of the DAG, so the points are the same: the end is
+    the first node of the last topological generation, and each node goes
+    back to its dominated node of the previous generation with the smallest
+    input index.
+    '''
+    x_screen1, y_screen1 = np.asarray(x_screen1), np.asarray(y_screen1)
+
+    # generation: the length of the longest path ending at a point
+    gens = np.empty(len(x_screen1), dtype=np.int64)
+    tails = []
+    for i in np.lexsort((y_screen1, x_screen1)):
+        k = bisect.bisect_right(tails, y_screen1[i])
+        if k == len(tails):
+            tails.append(y_screen1[i])
+        else:
+            tails[k] = y_screen1[i]
+        gens[i] = k
+    if len(tails) < 2: # no edge
+        return x_screen1[:0], y_screen1[:0]
+
+    # a generation is an antichain, by x ascending its y is descending
+    order = np.lexsort((x_screen1, gens))
+    members = np.split(order, np.cumsum(np.bincount(gens))[:-1])
+
+    # pos: the topological order in a generation. Sources are in the input
+    # order, others by the pos of their last processed pred then the index.
+    pos = np.empty(len(x_screen1), dtype=np.int64)
+    pred = np.empty(len(x_screen1), dtype=np.int64)
+    idx_prev = members[0]
+    pos[idx_prev] = np.argsort(np.argsort(idx_prev))
+    for idx in members[1:]:
+        # the dominated prevs are a range
+        hi = np.searchsorted(x_screen1[idx_prev], x_screen1[idx], 'right') - 1
+        lo = np.searchsorted(-y_screen1[idx_prev], -y_screen1[idx], 'left')
+        pred[idx] = range_reduce(idx_prev, lo, hi, np.minimum)
+        pos_last = range_reduce(pos[idx_prev], lo, hi, np.maximum)
+        rank = np.lexsort((idx, pos_last))
+        pos[idx[rank]] = np.arange(len(idx))
+        idx_prev = idx
+
+    path = [idx_prev[np.argmin(pos[idx_prev])]]
+    for _ in range(len(members) - 1):
+        path.append(pred[path[-1]])
+    path = np.array(path[::-1])
+    x_screen2, y_screen2 = x_screen1[path], y_screen1[path]
 
     return x_screen2, y_screen2
 
@@ -364,14 +424,47 @@ def fit_by_lowess(x, y, frac):
     return x_fit, y_fit
 
 
+def fit_by_sample(x, y, frac):
+    '''
+    LOWESS on a stratified sample of x (a random point of each equal-count
+    bin), so it is not quadratic on large seeds. The fit is checked by the
+    held-out points: their residuals should have the same center and
+    scale as the ones of the sample, within calib_sample_tol of the scale.
+    Otherwise all points are fitted.
+    '''
+    n, sample_num = len(x), param_g.calib_sample_num
+    if n <= 2 * sample_num:
+        return fit_by_lowess(x, y, frac)
+
+    order = np.argsort(x, kind='stable')
+    bins = np.linspace(0, n, sample_num + 1).astype(np.int64)
+    rng = np.random.default_rng(0)
+    pick = bins[:-1] + rng.integers(0, np.diff(bins))
+    is_sample = np.zeros(n, dtype=bool)
+    is_sample[order[pick]] = True
+
+    x_fit, y_fit = fit_by_lowess(x[is_sample], y[is_sample], frac)
+    f = interp1d(x_fit, y_fit, kind='cubic', fill_value='extrapolate')
+    resid_in = y[is_sample] - f(x[is_sample])
+    resid_out = y[~is_sample] - f(x[~is_sample])
+
+    scale_in = 1.4826 * np.median(np.abs(resid_in - np.median(resid_in)))
+    scale_out = 1.4826 * np.median(np.abs(resid_out - np.median(resid_out)))
+    tol = param_g.calib_sample_tol
+    is_converged = np.abs(np.median(resid_out)) <= tol * scale_in + 1e-12 and \
+                   np.abs(scale_out - scale_in) <= tol * scale_in + 1e-12
+    if is_converged:
+        return x_fit, y_fit
+
+    logger.info(f'Calib by {sample_num}/{n} seeds is not converged, by all.')
+    return fit_by_lowess(x, y, frac)
+
+
 def cal_turning_point(y_data, y_pred):
     tol_rt_v = np.arange(1., int(0.5 * y_data.max()), 0.1)
-    cover_num_v = []
-    for tol_rt in tol_rt_v:
-        bias = y_pred - y_data
-        cover_num = np.sum(np.abs(bias) < tol_rt)
-        cover_num_v.append(cover_num)
-    cover_nums = np.array(cover_num_v)
+    # the number of |bias| < tol of all tols by one sort
+    bias = np.sort(np.abs(y_pred - y_data))
+    cover_nums = np.searchsorted(bias, tol_rt_v, side='left')
 
     curve = cover_nums
     nPoints = len(curve)
@@ -9,6 +9,9 @@ import torch.optim as optim
 from torch.utils.data import DataLoader, TensorDataset
 
 from beta_dia import param_g
+from beta_dia import qvalue
+from beta_dia import segment
+from beta_dia import seqid
 from beta_dia import utils
 from beta_dia.log import Logger
 from beta_dia import fdr
@@ -27,8 +30,9 @@ logger = Logger.get_logger()
 def drop_batches_mismatch(df):
     # remove decoy duplicates
     df_decoy = df[df['decoy'] == 1]
-    idx_max = df_decoy.groupby('pr_id')['cscore_pr_run'].idxmax()
-    df_decoy = df_decoy.loc[idx_max].reset_index(drop=True)
+    idx_max = segment.group_argmax(df_decoy['pr_id'].values,
+                                   df_decoy['cscore_pr_run'].values)
+    df_decoy = df_decoy.iloc[idx_max].reset_index(drop=True)
 
     # remove decoy mismatch
     df_target = df[df['decoy'] == 0]
@@ -43,13 +47,15 @@ def drop_batches_mismatch(df):
 def drop_runs_mismatch(df):
     # remove decoy duplicates
     df_decoy = df[df['decoy'] == 1]
-    idx_max = df_decoy.groupby('pr_id')['cscore_pr_global'].idxmax()
-    df_decoy = df_decoy.loc[idx_max].reset_index(drop=True)
+    idx_max = segment.group_argmax(df_decoy['pr_id'].values,
+                                   df_decoy['cscore_pr_global'].values)
+    df_decoy = df_decoy.iloc[idx_max].reset_index(drop=True)
 
     # remove target duplicates
     df_target = df[df['decoy'] == 0]
-    idx_max = df_target.groupby('pr_id')['cscore_pr_global'].idxmax()
-    df_target = df_target.loc[idx_max].reset_index(drop=True)
+    idx_max = segment.group_argmax(df_target['pr_id'].values,
+                                   df_target['cscore_pr_global'].values)
+    df_target = df_target.iloc[idx_max].reset_index(drop=True)
 
     # remove decoy mismatch
     bad_idx = df_decoy['pr_id'].isin(df_target['pr_id'])
@@ -122,10 +128,10 @@ def cal_global(lib, top_k_fg, top_k_pr, multi_ws=[], df_v=[], df_global1=None):
 
     # polish prs
     df_global = drop_runs_mismatch(df_global)
-    df_global['pr_IL'] = df_global['pr_id'].replace(['I', 'L'], ['x', 'x'], regex=True)
-    idx_max = df_global.groupby('pr_IL')['cscore_pr_global'].idxmax()
-    df_global = df_global.loc[idx_max].reset_index(drop=True)
-    del df_global['pr_IL']
+    df_global = seqid.add_seq_ids(df_global)
+    idx_max = segment.group_argmax(df_global['il_id'].values,
+                                   df_global['cscore_pr_global'].values)
+    df_global = df_global.iloc[idx_max].reset_index(drop=True)
 
     # q_pr_global
     df_global = fdr.cal_q_pr_core(df_global, run_or_global='global')
@@ -133,18 +139,19 @@ def cal_global(lib, top_k_fg, top_k_pr, multi_ws=[], df_v=[], df_global1=None):
 
     # assemble: proteotypic, protein_id, protein_name, protein_group
     # cscore_pg_global, q_pg_global
-    df_global['simple_seq'] = df_global['pr_id'].str[:-1].replace(
-        ['C\(UniMod:4\)', 'M\(UniMod:35\)'], ['c', 'm'], regex=True
-    )
-    df_global['strip_seq'] = df_global['simple_seq'].str.upper()
     if df_global1 is None:
         df_global = lib.assign_proteins(df_global)
+        # df_global is sorted by cal_q_pr_core, the prs of a cut are a prefix
         q_cut_v = np.arange(0.01, 0.06, 0.01)
+        n_v = qvalue.num_at(df_global['q_pr_global'].values, q_cut_v)
         ids_001_v = []
-        for q_cut in q_cut_v:
-            df_tmp = df_global[df_global['q_pr_global'] < q_cut]
-            df_tmp = df_tmp.reset_index(drop=True).copy()
-            df_tmp = assemble.assemble_to_pg(df_tmp, q_cut, 'global')
+        for i, (q_cut, n) in enumerate(zip(q_cut_v, n_v)):
+            if i > 0 and n == n_v[i - 1]: # the same prs, the same pgs
+                ids_001_v.append(ids_001_v[-1])
+                continue
+            df_tmp = df_global.iloc[:n].reset_index(drop=True).copy()
+            df_tmp = assemble.assemble_to_pg(df_tmp, q_cut, 'global',
+                                             is_seq_out=False)
             df_tmp = fdr.cal_q_pg(df_tmp, q_cut, 'global')
             ids_001 = df_tmp[(df_tmp['q_pg_global'] < 0.01) & (df_tmp['decoy'] == 0)]['protein_group'].nunique()
             ids_001_v.append(ids_001)
@@ -152,7 +159,8 @@ def cal_global(lib, top_k_fg, top_k_pr, multi_ws=[], df_v=[], df_global1=None):
         logger.info(f'Select q_cut: {q_cut:.2f} for pg inference and score')
         param_g.q_cut_infer = q_cut
 
-        df_global = df_global[df_global['q_pr_global'] < q_cut].reset_index(drop=True)
+        n = n_v[np.argmax(ids_001_v)]
+        df_global = df_global.iloc[:n].reset_index(drop=True)
         df_global2 = df_global.copy()
         df_global2['protein_id'] = df_global2['protein_name']
 
@@ -406,6 +414,7 @@ def save_report_result(df_global, multi_ws=[], df_v=[]):
 
         # merge global info: cscore_global, q_global, quant pr/pg
         cols = df_global.columns[~df_global.columns.str.startswith('quant_')]
+        cols = cols.drop(seqid.cols_id, errors='ignore')
         cols_quant_pr = [f'{x}_{ws_i}' for x in ['quant_pr_raw', 'quant_pr_deep', 'quant_pr_mix']]
         cols_quant_pg = [f'{x}_{ws_i}' for x in ['quant_pg_raw', 'quant_pg_deep', 'quant_pg_mix']]
         cols = cols.tolist() + cols_quant_pr + cols_quant_pg
@@ -416,7 +425,7 @@ def save_report_result(df_global, multi_ws=[], df_v=[]):
         df = df.rename(columns=dict(zip(cols_quant_pg, cols_new)))
 
         # cal q_pg_run based on assigned protein_groups
-        df['cscore_pr_run'].fillna(0, inplace=True)
+        df['cscore_pr_run'] = df['cscore_pr_run'].fillna(0)
         df = fdr.cal_q_pg(df, param_g.q_cut_infer, 'run')
 
         # dtype
@@ -425,7 +434,8 @@ def save_report_result(df_global, multi_ws=[], df_v=[]):
         cols_big = df.select_dtypes(include=[np.float64]).columns
         df[cols_big] = df[cols_big].astype(np.float32)
 
-        # convert
+        # convert, ids are internal keys
+        df = df.drop(columns=seqid.cols_id, errors='ignore')
         df = utils.convert_cols_to_diann(df, param_g.multi_ws[ws_i])
         df_out_v.append(df)
     df = pd.concat(df_out_v, ignore_index=True)
@@ -1,10 +1,9 @@
-import math
-import operator
-
 import numpy as np
-from numba import cuda
+import pandas as pd
+from numba import jit, prange
 
 from beta_dia import param_g
+from beta_dia import seqid
 from beta_dia import utils
 from beta_dia.log import Logger
 
@@ -16,73 +15,109 @@ except:
 
 logger = Logger.get_logger()
 
-@cuda.jit(device=True)
-def sj_gpu_sum(array):
-    result = 0
-    for i in array:
-        result += i
-    return result
-
 
-@cuda.jit
-def gpu_cal_fg_mz(n,
-                  fg_num,
-                  mass_v,
-                  seq_len_cumsum_v,
-                  fg_type_m,
-                  fg_len_m,
-                  fg_charge_m,
-                  result_fg_mz):
+@jit(nopython=True, nogil=True, parallel=True)
+def cal_fg_mz_by_prefix(mass_cumsum, offsets, fg_type_m, fg_len_m,
+                        fg_charge_m):
     '''
-    Calculate the fragment ion m/z values of decoys.
-    Each thread is for an ion of a pr.
+    Fragment ion m/z values by the prefix sums of residue masses, each ion
+    is O(1): b is the sum of the first fg_len, y is of the last fg_len.
+    Args:
+        mass_cumsum: [len(codes) + 1], starts with 0
+        offsets: seq k is [offsets[k], offsets[k + 1])
     '''
-    thread_idx = cuda.threadIdx.x + cuda.blockDim.x * cuda.blockIdx.x
-    if thread_idx >= n:
-        return
-
-    k = thread_idx // fg_num
-    fg_idx = thread_idx % fg_num
-
-    # seq mass
-    start = seq_len_cumsum_v[k]
-    end = seq_len_cumsum_v[k + 1]
-    pep_mass_v = mass_v[start: end]
-
-    # fg
-    fg_type = fg_type_m[k, fg_idx]
-    fg_len = fg_len_m[k, fg_idx]
-    fg_charge = fg_charge_m[k, fg_idx]
+    n, fg_num = fg_type_m.shape
     mass_proton = 1.007276466771
     mass_h2o = 18.0105650638
+    result = np.zeros((n, fg_num), dtype=np.float32)
+    for k in prange(n):
+        start, end = offsets[k], offsets[k + 1]
+        for fg_idx in range(fg_num):
+            fg_type = fg_type_m[k, fg_idx]
+            fg_len = fg_len_m[k, fg_idx]
+            fg_charge = fg_charge_m[k, fg_idx]
+            if fg_type == 2:  # 'y'
+                mass = mass_cumsum[end] - mass_cumsum[end - fg_len]
+                mass = mass - (fg_len - 1) * mass_h2o
+            elif fg_type == 1:  # 'b'
+                mass = mass_cumsum[start + fg_len] - mass_cumsum[start]
+                mass = mass - fg_len * mass_h2o
+            else:
+                continue
+            result[k, fg_idx] = (mass + fg_charge * mass_proton) / fg_charge
+    return result
 
-    if fg_type == 2:  # 'y'
-        mass_v = pep_mass_v[-fg_len:]
-        mass = sj_gpu_sum(mass_v) - (fg_len - 1) * mass_h2o
-        mz = (mass + fg_charge * mass_proton) / fg_charge
-        result_fg_mz[k, fg_idx] = mz
-    elif fg_type == 1:  # 'b'
-        mass_v = pep_mass_v[:fg_len]
-        mass = sj_gpu_sum(mass_v) - fg_len * mass_h2o
-        mz = (mass + fg_charge * mass_proton) / fg_charge
-        result_fg_mz[k, fg_idx] = mz
 
+@jit(nopython=True, nogil=True)
+def expand_codes(codes, offsets, table, table_offsets):
+    '''
+    Replace each code by its bytes in the table, e.g. c -> C(UniMod:4).
+    '''
+    n = len(offsets) - 1
+    offsets_new = np.zeros(n + 1, dtype=np.int64)
+    for k in range(n):
+        size = 0
+        for i in range(offsets[k], offsets[k + 1]):
+            size += table_offsets[codes[i] + 1] - table_offsets[codes[i]]
+        offsets_new[k + 1] = offsets_new[k] + size
+    codes_new = np.empty(offsets_new[-1], dtype=np.uint8)
+    j = 0
+    for i in range(len(codes)):
+        for t in range(table_offsets[codes[i]], table_offsets[codes[i] + 1]):
+            codes_new[j] = table[t]
+            j += 1
+    return codes_new, offsets_new
+
+
+def get_code_tables():
+    '''
+    Returns:
+        mass_lut: residue code -> mass
+        mutate_lut: code -> mutated code, by the upper residue
+        mod_table, mod_offsets: code -> bytes of the modified residue
+    '''
+    mass_lut = np.zeros(256, dtype=np.float64)
+    for aa, mass in param_g.g_aa_to_mass.items():
+        mass_lut[ord(aa)] = mass
 
-def convert_seq_to_mass(simple_seq):
-    seq_len = simple_seq.str.len()
-    seq_len_cumsum = np.concatenate([[0], np.cumsum(seq_len)])
-    s = simple_seq.str.cat()
-    s = list(s)
+    mutate_lut = np.arange(256, dtype=np.uint8)
+    for old, new in zip('GAVLIFMPWSCTYHKRQEND', 'LLLVVLLLLTSSSSLLNDQE'):
+        mutate_lut[ord(old)] = ord(new)
+        mutate_lut[ord(old.lower())] = ord(new)
 
-    f = operator.itemgetter(*s)
-    mass = f(param_g.g_aa_to_mass)
+    mods = {'c': b'C(UniMod:4)', 'm': b'M(UniMod:35)'}
+    mod_v = [mods.get(chr(i), bytes([i])) for i in range(256)]
+    mod_offsets = np.zeros(257, dtype=np.int64)
+    mod_offsets[1:] = np.cumsum([len(x) for x in mod_v])
+    mod_table = np.frombuffer(b''.join(mod_v), dtype=np.uint8)
+    return mass_lut, mutate_lut, mod_table, mod_offsets
 
-    return mass, seq_len_cumsum
 
+def transform_codes(codes, offsets, method, mutate_lut):
+    '''
+    Decoy seqs on codes in one pass by the source index of each residue.
+    reverse: keep the last (KR) and reverse others
+    shift: x[2:] + x[:2]
+    mutate: the 2nd and the 2nd last are mutated
+    '''
+    lens = np.diff(offsets)
+    starts = np.repeat(offsets[:-1], lens)
+    lens_v = np.repeat(lens, lens)
+    rel = np.arange(len(codes)) - starts
+    if method == 'reverse':
+        src = np.where(rel < lens_v - 1, starts + lens_v - 2 - rel, starts + rel)
+        return codes[src]
+    if method == 'shift':
+        return codes[starts + (rel + 2) % lens_v]
+    if method == 'mutate':
+        codes = codes.copy()
+        idx = np.concatenate([offsets[:-1] + 1, offsets[1:] - 2])
+        codes[idx] = mutate_lut[codes[idx]]
+        return codes
+    return codes
 
-def cal_fg_mz_iso(df):
-    mass_neutron = 1.0033548378
 
+def cal_fg_mz_iso(df):
     cols_center = ['fg_mz_' + str(i) for i in range(param_g.fg_num)]
     fg_mz_m = df[cols_center].values
 
@@ -90,23 +125,15 @@ def cal_fg_mz_iso(df):
     fg_anno_m = df[cols_anno].values
     fg_charge_m = fg_anno_m % 10
 
-    fg_mz_left = (fg_mz_m * fg_charge_m - mass_neutron) / fg_charge_m
-    fg_mz_left[fg_mz_m <= 0.] = 0.
-    fg_mz_left = fg_mz_left.astype(np.float32)
-    cols_left = ['fg_mz_left_' + str(i) for i in range(param_g.fg_num)]
-    df[cols_left] = fg_mz_left
-
-    fg_mz_1H = (fg_mz_m * fg_charge_m + mass_neutron) / fg_charge_m
-    fg_mz_1H[fg_mz_m <= 0.] = 0.
-    fg_mz_1H = fg_mz_1H.astype(np.float32)
-    cols_1H = ['fg_mz_1H_' + str(i) for i in range(param_g.fg_num)]
-    df[cols_1H] = fg_mz_1H
-
-    fg_mz_2H = (fg_mz_m * fg_charge_m + 2 * mass_neutron) / fg_charge_m
-    fg_mz_2H[fg_mz_m <= 0.] = 0.
-    fg_mz_2H = fg_mz_2H.astype(np.float32)
-    cols_2H = ['fg_mz_2H_' + str(i) for i in range(param_g.fg_num)]
-    df[cols_2H] = fg_mz_2H
+    for name, neutron_num in [('left', -1), ('1H', 1), ('2H', 2)]:
+        cols = ['fg_mz_' + name + '_' + str(i) for i in range(param_g.fg_num)]
+        if param_g.is_fg_iso_lazy:
+            # by utils.get_fg_mz_iso when querying, drop the stale ones
+            df.drop(columns=[c for c in cols if c in df.columns],
+                    inplace=True)
+        else:
+            df[cols] = utils.cal_fg_mz_iso_m(fg_mz_m, fg_charge_m,
+                                             neutron_num)
 
     return df
 
@@ -124,11 +151,6 @@ def make_decoys(df_target, fg_num, method, value=1):
     Returns:
         df_decoy
     '''
-    # mutate_dict
-    mutate_dict = {}
-    for old, new in zip('GAVLIFMPWSCTYHKRQEND', 'LLLVVLLLLTSSSSLLNDQE'):
-        mutate_dict[old] = new
-
     # df_decoy
     if 'group_rank' in df_target.columns:
         df_decoy = df_target[df_target.group_rank == 1].copy()
@@ -142,75 +164,40 @@ def make_decoys(df_target, fg_num, method, value=1):
 
     df_decoy['decoy'] = np.uint8(value)
 
-    # change fg_mz
-    if method == 'reverse':  # keep KR
-        df_decoy['simple_seq'] = (
-                df_decoy['simple_seq'].str[:-1].str[::-1] +
-                df_decoy['simple_seq'].str[-1]
-        )
-    if method == 'shift':
-        x = df_decoy['simple_seq']
-        df_decoy['simple_seq'] = x.str[2:] + x.str[:2]
-    elif method == 'mutate':
-        second_bone_C = df_decoy.simple_seq.str[-2].str.upper()
-        f = operator.itemgetter(*second_bone_C)
-        second_bone_C = f(mutate_dict)
-
-        second_bone_N = df_decoy.simple_seq.str[1].str.upper()
-        f = operator.itemgetter(*second_bone_N)
-        second_bone_N = f(mutate_dict)
-
-        mutate = (df_decoy.simple_seq.str[0] + second_bone_N +
-                  df_decoy.simple_seq.str[2:-2] + second_bone_C +
-                  df_decoy.simple_seq.str[-1])
-        df_decoy['simple_seq'] = mutate
+    # change seqs on residue codes
+    mass_lut, mutate_lut, mod_table, mod_offsets = get_code_tables()
+    codes, offsets = seqid.encode_seqs(df_decoy['simple_seq'])
+    codes = transform_codes(codes, offsets, method, mutate_lut)
+    df_decoy['simple_seq'] = seqid.decode_seqs(codes, offsets).values
 
     # update pr_id
-    ModifiedPeptide = df_decoy['simple_seq'].replace(
-        ['c', 'm'], ['C(UniMod:4)', 'M(UniMod:35)'], regex=True)
-    df_decoy['pr_id'] = ModifiedPeptide + df_decoy['pr_charge'].astype(str)
+    codes, offsets = expand_codes(codes, offsets, mod_table, mod_offsets)
+    ModifiedPeptide = seqid.decode_seqs(codes, offsets)
+    df_decoy['pr_id'] = ModifiedPeptide.values + \
+                        df_decoy['pr_charge'].astype(str).values
+    if seqid.cols_id[0] in df_decoy.columns:
+        df_decoy = seqid.add_seq_ids(df_decoy, is_overwrite=True)
 
     # drop duplicates and mismatch to target seqs
     df_decoy = df_decoy.drop_duplicates(subset='pr_id').reset_index(drop=True)
-    bad_idx = df_decoy['pr_id'].isin(set(df_target['pr_id']))
+    # by the hash index, isin of str dtype is much slower
+    target_ids = pd.Index(df_target['pr_id'].unique())
+    bad_idx = target_ids.get_indexer(df_decoy['pr_id']) >= 0
     df_decoy = df_decoy.loc[~bad_idx].reset_index(drop=True)
 
-    # calculating fg_mass in batches
-    fg_mz_v = []
-
-    for _, df_batch in df_decoy.groupby(df_decoy.index // 50000):
-        # fg_anno: 2251 means y25_1
-        cols_anno = ['fg_anno_' + str(i) for i in range(fg_num)]
-        fg_anno = df_batch[cols_anno].values
-        fg_type = (fg_anno // 1000).astype(np.int8)  # y-2, b-1, x-3
-        fg_charge = (fg_anno % 10).astype(np.int8)
-        fg_len = (fg_anno // 10 % 100).astype(np.int8)
-
-        mass, seq_len_cumsum = convert_seq_to_mass(df_batch['simple_seq'])
-
-        # by cuda
-        mass = cuda.to_device(mass)
-        seq_len_cumsum = cuda.to_device(seq_len_cumsum)
-        fg_type = cuda.to_device(fg_type)
-        fg_len = cuda.to_device(fg_len)
-        fg_charge = cuda.to_device(fg_charge)
-        result_fg_mz = utils.create_cuda_zeros((len(df_batch), fg_num))
-
-        # kernel func
-        n = result_fg_mz.shape[0] * result_fg_mz.shape[1]
-        threads_per_block = 512
-        blocks_per_grid = math.ceil(n / threads_per_block)
-        gpu_cal_fg_mz[blocks_per_grid, threads_per_block](n,
-                                                          fg_num,
-                                                          mass,
-                                                          seq_len_cumsum,
-                                                          fg_type,
-                                                          fg_len,
-                                                          fg_charge,
-                                                          result_fg_mz)
-        cuda.synchronize()
-        fg_mz_v.append(result_fg_mz.copy_to_host())
-    fg_mz_v = np.vstack(fg_mz_v)
+    # fg_mz by prefix sums of residue masses
+    # fg_anno: 2251 means y25_1
+    cols_anno = ['fg_anno_' + str(i) for i in range(fg_num)]
+    fg_anno = df_decoy[cols_anno].values
+    fg_type = (fg_anno // 1000).astype(np.int8)  # y-2, b-1, x-3
+    fg_charge = (fg_anno % 10).astype(np.int8)
+    fg_len = (fg_anno // 10 % 100).astype(np.int8)
+
+    codes, offsets = seqid.encode_seqs(df_decoy['simple_seq'])
+    mass_cumsum = np.zeros(len(codes) + 1, dtype=np.float64)
+    mass_cumsum[1:] = np.cumsum(mass_lut[codes])
+    fg_mz_v = cal_fg_mz_by_prefix(mass_cumsum, offsets, fg_type, fg_len,
+                                  fg_charge)
     cols_center = ['fg_mz_' + str(i) for i in range(fg_mz_v.shape[1])]
     df_decoy[cols_center] = fg_mz_v
     return df_decoy
@@ -1,7 +1,10 @@
+import time
+
 import numpy as np
 import torch
 
 from beta_dia import fxic
+from beta_dia import models
 from beta_dia import param_g
 from beta_dia import utils
 from beta_dia.log import Logger
@@ -14,6 +17,26 @@ except:
 
 logger = Logger.get_logger()
 
+def pack_mall_attributes(df_batch, rts):
+    '''
+    Pack the pr attributes used by the mall to a matrix to upload once.
+    Returns:
+        [n_pep, pred_im + (fg_mz, height, anno, sa, snr) * fg_num +
+                span_left + span_right + rts]
+    '''
+    ion_idx = range(param_g.fg_num)
+    cols = (['pred_im'] +
+            ['fg_mz_' + str(i) for i in ion_idx] +
+            ['fg_height_' + str(i) for i in ion_idx] +
+            ['fg_anno_' + str(i) for i in ion_idx] +
+            ['score_center_elution_' + str(i + 2) for i in ion_idx] +
+            ['score_center_snr_' + str(i + 2) for i in ion_idx] +
+            ['score_elute_span_left', 'score_elute_span_right'])
+    attrs = df_batch[cols].to_numpy(dtype=np.float32)
+    attrs = np.concatenate([attrs, rts.astype(np.float32)], axis=1)
+    return attrs
+
+
 def extract_mall(
         df_batch,
         map_gpu_ms1,
@@ -34,92 +57,69 @@ def extract_mall(
         Malls: [measure spectrum, bias_im, ppm] * 3, pred, type, area, sa, snr
     '''
     # measure spectrum with smooth
-    locus, rts, ims, mzs, xics = fxic.extract_xics(
+    _, rts, ims, mzs, xics = fxic.extract_xics(
         df_batch,
         map_gpu_ms1,
         map_gpu_ms2,
         im_tolerance=tol_im,
         ppm_tolerance=tol_ppm,
-        cycle_num = 13,
+        cycle_num=13,
+        im_mz_on_device=True,
     )
-
-    # [n_pep, n_ion, n_cycle]
     xics = fxic.gpu_simple_smooth(xics)
+
+    # [n_pep, n_ion, n_cycle], all on GPU
     ims = utils.convert_numba_to_tensor(ims)[:, 2:, :]
     mzs = utils.convert_numba_to_tensor(mzs)[:, 2:, :]
     xics = utils.convert_numba_to_tensor(xics)[:, 2:, :]
 
+    # pr attributes by one upload
+    fg_num = param_g.fg_num
+    attrs = pack_mall_attributes(df_batch, rts)
+    attrs = torch.from_numpy(attrs).to(param_g.gpu_id)
+    pred_ims = attrs[:, 0]
+    fg_attrs = attrs[:, 1 : (1 + 5 * fg_num)].reshape(-1, 5, fg_num)
+    pred_mzs, pred_heights, fg_anno, elutions, snr = fg_attrs.unbind(dim=1)
+    locus_start_v = attrs[:, 1 + 5 * fg_num]
+    locus_end_v = attrs[:, 2 + 5 * fg_num]
+    rts = attrs[:, (3 + 5 * fg_num):]
+
     center_idx = int((xics.shape[-1] - 1) / 2)
-    xics_mall = xics[:, :, (center_idx - 1) : (center_idx + 2)]
-    xics_mall = xics_mall.permute((0, 2, 1)) # [n_pep, n_cycle, n_ion]
+    cycles = slice(center_idx - 1, center_idx + 2)
+    xics_mall = xics[:, :, cycles].permute((0, 2, 1)) # [n_pep, n_cycle, n_ion]
     xics_mall = xics_mall / (torch.amax(xics_mall, dim=-1, keepdim=True) + 1e-7)
 
     # bias_im
-    ims = ims.permute((0, 2, 1))
-    ims = ims[:, (center_idx - 1) : (center_idx + 2), :]
-    pred_ims = df_batch['pred_im'].values
-    pred_ims = torch.from_numpy(pred_ims).to(param_g.gpu_id)
-    pred_ims = pred_ims.unsqueeze(-1).unsqueeze(-1).expand(ims.shape)
-    bias_ims = pred_ims - ims
+    ims = ims[:, :, cycles].permute((0, 2, 1))
+    bias_ims = pred_ims[:, None, None] - ims
     bias_ims[ims < 0] = param_g.tol_im_xic
     bias_ims = bias_ims / param_g.tol_im_xic
 
     # ppm
-    mzs = mzs.permute((0, 2, 1))
-    mzs = mzs[:, (center_idx - 1) : (center_idx + 2), :]
-    cols_center = ['fg_mz_' + str(i) for i in range(param_g.fg_num)]
-    pred_mzs = df_batch[cols_center].values
-    pred_mzs = torch.from_numpy(pred_mzs).to(param_g.gpu_id)
-    pred_mzs = pred_mzs.unsqueeze(1).expand(mzs.shape)
+    mzs = mzs[:, :, cycles].permute((0, 2, 1))
+    pred_mzs = pred_mzs[:, None, :]
     ppms = 1e6 * (pred_mzs - mzs) / (pred_mzs + 1e-7)
     ppms[mzs < 1] = param_g.tol_ppm
     ppms = ppms / param_g.tol_ppm
 
-    # sa
-    cols = ['score_center_elution_' + str(i) for i in range(14)]
-    elutions = df_batch[cols].values[:, 2:]
-    elutions = torch.from_numpy(elutions).to(param_g.gpu_id)
-    elutions = elutions.unsqueeze(1)
-
     # area
-    locus_start_v = df_batch['score_elute_span_left'].values
-    locus_end_v = df_batch['score_elute_span_right'].values
-    xics = xics.cpu().numpy()
-    mask1 = np.arange(xics.shape[2]) >= locus_start_v[:, None, None]
-    mask2 = np.arange(xics.shape[2]) <= locus_end_v[:, None, None]
-    xics = xics * mask1 * mask2
-    rts = np.repeat(rts[:, np.newaxis, :], xics.shape[1], axis=1)
-    areas = np.trapz(xics, x=rts, axis=2)
-    areas = areas / (areas.max(axis=1, keepdims=True) + 1e-7)
-    areas = torch.from_numpy(areas).to(param_g.gpu_id)
-    areas = areas.unsqueeze(1)
-
-    # pred intensities
-    cols_height = ['fg_height_' + str(i) for i in range(param_g.fg_num)]
-    pred_heights = df_batch[cols_height].values
-    pred_heights = torch.from_numpy(pred_heights).to(param_g.gpu_id)
-    pred_heights = pred_heights.unsqueeze(1)
+    cycle_idx = torch.arange(xics.shape[2], device=xics.device)
+    mask = ((cycle_idx >= locus_start_v[:, None]) &
+            (cycle_idx <= locus_end_v[:, None]))
+    areas = torch.trapezoid(xics * mask[:, None, :], x=rts[:, None, :], dim=2)
+    areas = areas / (areas.amax(dim=1, keepdim=True) + 1e-7)
 
     # ion type
-    cols_anno = ['fg_anno_' + str(i) for i in range(param_g.fg_num)]
-    fg_type = df_batch[cols_anno].values // 1000
-    fg_type = torch.from_numpy(fg_type.astype(np.float32)).to(param_g.gpu_id)
-    fg_type = fg_type.unsqueeze(1)
-
-    # snr
-    cols = ['score_center_snr_' + str(i) for i in range(14)]
-    snr = df_batch[cols].values[:, 2:]
-    snr = torch.from_numpy(snr).to(param_g.gpu_id)
-    snr = snr.unsqueeze(1)
-
-    mall = torch.cat([pred_heights,
+    fg_type = torch.div(fg_anno, 1000, rounding_mode='floor')
+
+    mall = torch.cat([pred_heights.unsqueeze(1),
                       xics_mall,
                       ppms,
                       bias_ims,
-                      fg_type,
-                      elutions,
-                      areas,
-                      snr], dim=1)
+                      fg_type.unsqueeze(1),
+                      elutions.unsqueeze(1),
+                      areas.unsqueeze(1),
+                      snr.unsqueeze(1)], dim=1)
     return mall
 
 
@@ -151,8 +151,19 @@ def scoring_mall(
                         tol_ppm)
     valid_ion_nums = df_input['fg_num'].values
     valid_ion_nums = torch.from_numpy(valid_ion_nums).long().to(param_g.gpu_id)
+    is_padded = param_g.is_mall_padded
+    if is_padded and model_mall.is_padded_ok is None:
+        is_equal, is_faster = model_mall.check_padded(mall, valid_ion_nums)
+        model_mall.is_padded_ok = is_equal and is_faster
+        if not is_equal:
+            logger.warning('DeepMall padded inference differs, use packed.')
+        elif not is_faster:
+            logger.info('DeepMall padded inference is slower, use packed.')
     with torch.no_grad():
-        feature, pred = model_mall(mall, valid_ion_nums)
+        if is_padded and model_mall.is_padded_ok:
+            feature, pred = model_mall.forward_padded(mall, valid_ion_nums)
+        else:
+            feature, pred = model_mall(mall, valid_ion_nums)
 
     pred = torch.softmax(pred, 1)
     pred = pred[:, 1].cpu().numpy()
@@ -160,3 +171,46 @@ def scoring_mall(
     feature = feature.cpu().numpy()
 
     return pred, feature
+
+
+def bench_mall_padded(model_mall=None, n_v=(2000, 5000, 10000, 20000),
+                      repeat=3, device=None):
+    '''
+    Equivalence and throughput of DeepMall.forward_padded vs. the packed
+    forward on random malls of n_v sizes, for is_mall_padded.
+    Returns:
+        [(n, max abs diff of pred, packed malls/s, padded malls/s)]
+    '''
+    if device is None:
+        device = 'cpu' if param_g.gpu_id is None else param_g.gpu_id
+    if model_mall is None:
+        torch.manual_seed(0)
+        model_mall = models.DeepMall(input_dim=14, feature_dim=32)
+    model_mall = model_mall.to(device).eval()
+    input_dim = model_mall.xic_gru.input_size
+    fg_num = param_g.fg_num
+
+    def run(func, *args):
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            with torch.no_grad():
+                result = func(*args)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        return result, (time.perf_counter() - t0) / repeat
+
+    result_v = []
+    for n in n_v:
+        gen = torch.Generator().manual_seed(n)
+        mall = torch.rand(n, input_dim, fg_num, generator=gen).to(device)
+        valid_nums = torch.randint(1, fg_num + 1, (n,), generator=gen)
+        valid_nums = valid_nums.to(device)
+        (_, pred), t_packed = run(model_mall, mall, valid_nums)
+        (_, pred_p), t_padded = run(model_mall.forward_padded, mall,
+                                    valid_nums)
+        diff = (pred - pred_p).abs().max().item()
+        result_v.append((n, diff, n / t_packed, n / t_padded))
+        info = 'DeepMall padded check, n: {}, diff: {:.1e}, malls/s ' \
+               'packed: {:.0f}, padded: {:.0f}'.format(*result_v[-1])
+        logger.info(info)
+    return result_v
@@ -320,29 +320,23 @@ def extract_maps(df_batch,
     elif neutron_num == 1:
         query_mz_ms1 = df_batch['pr_mz_1H'].values
         query_mz_ms1 = np.tile(query_mz_ms1, (2, 1)).T
-        cols_1H = ['fg_mz_1H_' + str(i) for i in range(param_g.fg_num)]
-        query_mz_ms2 = df_batch[cols_1H].values
+        query_mz_ms2 = utils.get_fg_mz_iso(df_batch, 1)
         query_mz_m = np.concatenate([query_mz_ms1, query_mz_ms2], axis=1)
         ms1_ion_num = 1
     elif neutron_num == 2:
         query_mz_ms1 = df_batch['pr_mz_2H'].values
         query_mz_ms1 = np.tile(query_mz_ms1, (2, 1)).T
-        cols_2H = ['fg_mz_2H_' + str(i) for i in range(param_g.fg_num)]
-        query_mz_ms2 = df_batch[cols_2H].values
+        query_mz_ms2 = utils.get_fg_mz_iso(df_batch, 2)
         query_mz_m = np.concatenate([query_mz_ms1, query_mz_ms2], axis=1)
         ms1_ion_num = 1
     elif neutron_num > 2:  # total
         ms1_cols = ['pr_mz_left', 'pr_mz', 'pr_mz_1H', 'pr_mz_2H',
                     'pr_mz_left', 'pr_mz', 'pr_mz_1H', 'pr_mz_2H'] # unfrag
         ms1 = df_batch[ms1_cols].values
-        cols_left = ['fg_mz_left_' + str(i) for i in range(param_g.fg_num)]
-        left = df_batch[cols_left].values
-        cols_center = ['fg_mz_' + str(i) for i in range(param_g.fg_num)]
-        center = df_batch[cols_center].values
-        cols_1H = ['fg_mz_1H_' + str(i) for i in range(param_g.fg_num)]
-        fg_1H = df_batch[cols_1H].values
-        cols_2H = ['fg_mz_2H_' + str(i) for i in range(param_g.fg_num)]
-        fg_2H = df_batch[cols_2H].values
+        left = utils.get_fg_mz_iso(df_batch, -1)
+        center = utils.get_fg_mz_iso(df_batch, 0)
+        fg_1H = utils.get_fg_mz_iso(df_batch, 1)
+        fg_2H = utils.get_fg_mz_iso(df_batch, 2)
         query_mz_m = np.concatenate([ms1, left, center, fg_1H, fg_2H], axis=1)
         ms1_ion_num = 4
     else:
@@ -520,14 +514,10 @@ def extract_scoring_big(
     ms1_cols = ['pr_mz_left', 'pr_mz', 'pr_mz_1H', 'pr_mz_2H',
                 'pr_mz_left', 'pr_mz', 'pr_mz_1H', 'pr_mz_2H']  # unfrag
     ms1 = df_input[ms1_cols].values
-    cols_left = ['fg_mz_left_' + str(i) for i in range(param_g.fg_num)]
-    left = df_input[cols_left].values
-    cols_center = ['fg_mz_' + str(i) for i in range(param_g.fg_num)]
-    center = df_input[cols_center].values
-    cols_1H = ['fg_mz_1H_' + str(i) for i in range(param_g.fg_num)]
-    fg_1H = df_input[cols_1H].values
-    cols_2H = ['fg_mz_2H_' + str(i) for i in range(param_g.fg_num)]
-    fg_2H = df_input[cols_2H].values
+    left = utils.get_fg_mz_iso(df_input, -1)
+    center = utils.get_fg_mz_iso(df_input, 0)
+    fg_1H = utils.get_fg_mz_iso(df_input, 1)
+    fg_2H = utils.get_fg_mz_iso(df_input, 2)
     query_mz_m = np.concatenate([ms1, left, center, fg_1H, fg_2H], axis=1)
     ms1_ion_num = 4
 
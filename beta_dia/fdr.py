@@ -9,14 +9,21 @@ from sklearn.neural_network import MLPClassifier
 from sklearn.exceptions import ConvergenceWarning
 from sklearn.ensemble import VotingClassifier
 from joblib import Parallel, delayed
+import torch
+import torch.nn.functional as F
 
 import warnings
 warnings.simplefilter("ignore")
 warnings.filterwarnings(action='ignore', category=UserWarning)
 warnings.filterwarnings(action='ignore', category=ConvergenceWarning)
 
+from beta_dia import features
 from beta_dia import utils
 from beta_dia import param_g
+from beta_dia import qvalue
+from beta_dia import segment
+from beta_dia import seqid
+from beta_dia import spill
 from beta_dia.log import Logger
 
 try:
@@ -69,6 +76,195 @@ class SoftVotingMLPEnsemble:
         return np.mean(probas, axis=0)
 
 
+class StreamingMLPEnsemble:
+    '''
+    Out-of-core NN ensemble. The scaler is fitted by running statistics and
+    MLPs by partial_fit on row chunks, so neither the full score matrix nor
+    its scaled copy is materialized. Prediction is chunk-wise too.
+    '''
+    def __init__(self, n_model, batch_size):
+        param = (25, 20, 15, 10, 5)
+        self.scaler = preprocessing.StandardScaler()
+        self.estimators_ = [MLPClassifier(shuffle=True,
+                                          random_state=i,
+                                          learning_rate_init=0.003,
+                                          solver='adam',
+                                          batch_size=batch_size,
+                                          activation='relu',
+                                          hidden_layer_sizes=param)
+                            for i in range(n_model)]
+        self.n_jobs = 1 if __debug__ else n_model
+
+    def fit_scaler(self, chunks):
+        for X, _ in chunks:
+            self.scaler.partial_fit(X)
+
+    def partial_fit(self, X, y):
+        X = self.scaler.transform(X)
+        # threads share X without pickling
+        Parallel(n_jobs=self.n_jobs, prefer='threads')(
+            delayed(est.partial_fit)(X, y, classes=[0, 1])
+            for est in self.estimators_
+        )
+
+    def predict_proba(self, X):
+        X = self.scaler.transform(X)
+        probas = [est.predict_proba(X) for est in self.estimators_]
+        return np.mean(probas, axis=0)
+
+    def predict_proba_chunks(self, chunks):
+        return np.concatenate([self.predict_proba(X) for X, _ in chunks])
+
+
+class TorchMLPEnsemble:
+    '''
+    NN ensemble trained as one batched network. The weights of members are
+    stacked as [n_model, in, out] and all members step together by bmm on CPU
+    threads, so there are no estimator copies or pickled X as by joblib. Each
+    member keeps its own seed for init and shuffle. Training follows the
+    MLPClassifier: glorot uniform init, relu, adam, log loss with L2 (alpha).
+    '''
+    def __init__(self, n_model, batch_size, max_iter=1, lr=0.003,
+                 alpha=0.0001, hidden_layer_sizes=(25, 20, 15, 10, 5)):
+        self.n_model = n_model
+        self.batch_size = batch_size
+        self.max_iter = max_iter
+        self.lr = lr
+        self.alpha = alpha
+        self.hidden_layer_sizes = hidden_layer_sizes
+        self.classes_ = np.array([0, 1])
+        self.weights, self.biases = None, None
+
+    def init_weights(self, n_feature):
+        sizes = [n_feature, *self.hidden_layer_sizes, 1]
+        self.gens = [torch.Generator().manual_seed(i)
+                     for i in range(self.n_model)]
+        self.weights, self.biases = [], []
+        for fan_in, fan_out in zip(sizes[:-1], sizes[1:]):
+            bound = np.sqrt(6. / (fan_in + fan_out))
+            w = [(torch.rand(fan_in, fan_out, generator=g) * 2 - 1) * bound
+                 for g in self.gens]
+            b = [(torch.rand(1, fan_out, generator=g) * 2 - 1) * bound
+                 for g in self.gens]
+            self.weights.append(torch.stack(w).requires_grad_())
+            self.biases.append(torch.stack(b).requires_grad_())
+        self.optimizer = torch.optim.Adam(self.weights + self.biases,
+                                          lr=self.lr, eps=1e-8)
+
+    def forward(self, x):
+        # x: [n_model, n, in], or [n, in] shared by members
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            x = torch.matmul(x, w) + b
+            if i < len(self.weights) - 1:
+                x = torch.relu(x)
+        return x.squeeze(-1)
+
+    def partial_fit(self, X, y, classes=None):
+        '''
+        One epoch over X for all members, each by its own shuffle.
+        '''
+        X = torch.from_numpy(np.ascontiguousarray(X, dtype=np.float32))
+        y = torch.from_numpy(np.asarray(y, dtype=np.float32))
+        if self.weights is None:
+            self.init_weights(X.shape[1])
+
+        idx = torch.stack([torch.randperm(len(X), generator=g)
+                           for g in self.gens])
+        for start in range(0, len(X), self.batch_size):
+            idx_batch = idx[:, start : start + self.batch_size]
+            n = idx_batch.shape[1]
+            logits = self.forward(X[idx_batch])
+            # members are independent, the sum of their losses
+            loss = F.binary_cross_entropy_with_logits(
+                logits, y[idx_batch], reduction='sum'
+            ) / n
+            l2 = sum((w ** 2).sum() for w in self.weights)
+            loss = loss + 0.5 * self.alpha * l2 / n
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+        return self
+
+    def fit(self, X, y):
+        self.weights = None
+        for _ in range(self.max_iter):
+            self.partial_fit(X, y)
+        return self
+
+    @torch.no_grad()
+    def predict_proba(self, X, chunk_rows=100000):
+        probas = []
+        for i in range(0, len(X), chunk_rows):
+            x = np.ascontiguousarray(X[i : i + chunk_rows], dtype=np.float32)
+            x = torch.from_numpy(x)
+            probas.append(torch.sigmoid(self.forward(x)).mean(dim=0))
+        proba = torch.cat(probas).numpy()
+        return np.stack([1 - proba, proba], axis=1)
+
+
+def get_nn_model(n_model, batch_size, max_iter=1, n_jobs=None):
+    '''
+    Soft voting MLPs for FDR. The batched torch ensemble if is_fdr_torch.
+    n_jobs caps the processes of the members, n_model by default.
+    '''
+    if param_g.is_fdr_torch:
+        return TorchMLPEnsemble(n_model, batch_size, max_iter)
+
+    param = (25, 20, 15, 10, 5)
+    mlps = [MLPClassifier(max_iter=max_iter,
+                          shuffle=True,
+                          random_state=i,  # init weights and shuffle
+                          learning_rate_init=0.003,
+                          solver='adam',
+                          batch_size=batch_size,  # DIA-NN is 50
+                          activation='relu',
+                          hidden_layer_sizes=param) for i in range(n_model)]
+    names = [f'mlp{i}' for i in range(n_model)]
+    model = VotingClassifier(estimators=list(zip(names, mlps)),
+                             voting='soft',
+                             n_jobs=1 if __debug__ else n_jobs or n_model)
+    return model
+
+
+def iter_score_chunks(df, rows=None, chunk_rows=None, readers=None):
+    '''
+    Row chunks of the score matrix and labels. Score columns are selected
+    before the rows are sliced, spilled columns are read by the chunk rows.
+    '''
+    chunk_rows = param_g.fdr_chunk_rows if chunk_rows is None else chunk_rows
+    rows = np.arange(len(df)) if rows is None else rows
+    decoys = df['decoy'].values
+    for i in range(0, len(rows), chunk_rows):
+        rows_chunk = rows[i : i + chunk_rows]
+        X, _ = features.get_score_matrix(df, rows=rows_chunk, readers=readers)
+        yield X, 1 - decoys[rows_chunk]
+
+
+def shuffle_train_rows(df, train_rows, readers, chunk_rows=None):
+    '''
+    Rows shuffled across chunks for the partial fits. With spilled scores,
+    rows of a spill row group are kept together in a random group order and
+    then shuffled in each chunk, so a chunk reads a few row groups instead
+    of all of them.
+    '''
+    chunk_rows = param_g.fdr_chunk_rows if chunk_rows is None else chunk_rows
+    rng = np.random.default_rng(0)
+    if len(readers) == 0:
+        return rng.permutation(train_rows)
+
+    reader = readers[0]
+    spill_rows = df[reader.col_row].to_numpy()[train_rows]
+    groups = np.full(len(train_rows), len(reader.starts) - 1)
+    valid = ~pd.isna(spill_rows)
+    groups[valid] = np.searchsorted(reader.starts,
+                                    spill_rows[valid], side='right') - 1
+    group_order = rng.permutation(len(reader.starts))
+    train_rows = train_rows[np.argsort(group_order[groups], kind='stable')]
+    for i in range(0, len(train_rows), chunk_rows):
+        rng.shuffle(train_rows[i : i + chunk_rows])
+    return train_rows
+
+
 def adjust_rubbish_q(df, batch_num):
     ids = df[(df['q_pr_run'] < 0.01) &
              (df['decoy'] == 0) &
@@ -84,25 +280,75 @@ def cal_q_pr_core(df, run_or_global):
     col_score = 'cscore_pr_' + run_or_global
     col_out = 'q_pr_' + run_or_global
 
-    df = df.sort_values(by=col_score, ascending=False, ignore_index=True)
-    target_num = (df.decoy == 0).cumsum()
-    decoy_num = (df.decoy == 1).cumsum()
+    order = qvalue.sort_desc(df[col_score].values)
+    df = df.iloc[order].reset_index(drop=True)
+    df[col_out] = qvalue.q_sorted(df['decoy'].values)
+    return df
 
-    target_num[target_num == 0] = 1
-    df[col_out] = decoy_num / target_num
 
-    df[col_out] = df[col_out][::-1].cummin()
-    return df
+@profile
+def cal_q_pr_batch_stream(df, batch_size, n_model, model_trained=None):
+    '''
+    cal_q_pr_batch by the out-of-core StreamingMLPEnsemble. Peak memory of
+    FDR is a chunk of scores, target_batch_max can be enlarged to the library.
+    '''
+    readers = spill.get_spill_readers(df) # once for the chunks of the pass
+    cols = features.get_score_cols(df, readers=readers)
+    assert len(cols) == 392
+
+    n_pos, n_neg = sum(df['decoy'] == 0), sum(df['decoy'] == 1)
+    if model_trained is None: # the first batch
+        decoy_deeps = df.loc[df['decoy'] == 1, 'score_big_deep_pre'].values
+        decoy_m, decoy_u = np.mean(decoy_deeps), np.std(decoy_deeps)
+        good_cut = min(0.5, decoy_m + 1.5 * decoy_u)
+        logger.info(f'Training with big_score_cut: {good_cut:.2f}')
+        train_idx = (df['group_rank'] == 1) & (df['score_big_deep_pre'] > good_cut)
+        train_rows = np.flatnonzero(train_idx.values)
+        y_train = 1 - df['decoy'].values[train_rows]
+
+        info = 'Training the NN model: {} pos, {} neg'.format(
+            sum(y_train == 1), sum(y_train == 0)
+        )
+        logger.info(info)
+
+        model = StreamingMLPEnsemble(n_model, batch_size)
+        model.fit_scaler(iter_score_chunks(df, readers=readers))
+        # rows are sorted by swath, shuffle them across chunks
+        if len(train_rows) > param_g.fdr_chunk_rows:
+            train_rows = shuffle_train_rows(df, train_rows, readers)
+        model_chunks = iter_score_chunks(df, train_rows, readers=readers)
+        for X_chunk, y_chunk in model_chunks:
+            model.partial_fit(X_chunk, y_chunk)
+    else:
+        model = model_trained
+
+    info = 'Predicting by the NN model: {} pos, {} neg'.format(n_pos, n_neg)
+    logger.info(info)
+    cscore = model.predict_proba_chunks(
+        iter_score_chunks(df, readers=readers)
+    )[:, 1]
+    df['cscore_pr_run'] = cscore
+
+    # group rank
+    offsets = segment.get_offsets(df['pr_id'].values)
+    group_rank = segment.segment_rank(df['cscore_pr_run'].values, offsets)
+    df['group_rank'] = group_rank
+    df = df.loc[group_rank == 1]
+
+    df = cal_q_pr_core(df, 'run')
+
+    return df, model, model.scaler
 
 
 @profile
 def cal_q_pr_batch(df, batch_size, n_model, model_trained=None, scaler=None):
-    col_idx = df.columns.str.startswith('score_')
-    assert sum(col_idx) == 392
-    # logger.info('cols num: {}'.format(sum(col_idx)))
+    if param_g.is_fdr_stream:
+        return cal_q_pr_batch_stream(df, batch_size, n_model, model_trained)
+
+    X, cols = features.get_score_matrix(df)
+    assert len(cols) == 392
+    # logger.info('cols num: {}'.format(len(cols)))
 
-    X = df.loc[:, col_idx].values
-    assert X.dtype == np.float32
     y = 1 - df['decoy'].values  # targets is positives
     if scaler is None:
         scaler = preprocessing.StandardScaler()
@@ -124,20 +370,9 @@ def cal_q_pr_batch(df, batch_size, n_model, model_trained=None, scaler=None):
         info = 'Training the NN model: {} pos, {} neg'.format(n_pos, n_neg)
         logger.info(info)
 
-        param = (25, 20, 15, 10, 5)
-        mlps = [MLPClassifier(max_iter=1,
-                              shuffle=True,
-                              random_state=i,  # init weights and shuffle
-                              learning_rate_init=0.003,
-                              solver='adam',
-                              batch_size=batch_size,  # DIA-NN is 50
-                              activation='relu',
-                              hidden_layer_sizes=param) for i in range(n_model)]
-        names = [f'mlp{i}' for i in range(n_model)]
-        model = VotingClassifier(estimators=list(zip(names, mlps)),
-                                 voting='soft',
-                                 n_jobs=1 if __debug__ else n_model)
-        model.fit(X_train, y_train)
+        model = get_nn_model(n_model, batch_size)
+        with features.shared_matrix(X_train) as X_train:
+            model.fit(X_train, y_train)
 
         n_pos, n_neg = sum(y == 1), sum(y == 0)
         info = 'Predicting by the NN model: {} pos, {} neg'.format(n_pos, n_neg)
@@ -153,9 +388,8 @@ def cal_q_pr_batch(df, batch_size, n_model, model_trained=None, scaler=None):
     df['cscore_pr_run'] = cscore
 
     # group rank
-    group_size = df.groupby('pr_id', sort=False).size()
-    group_size_cumsum = np.concatenate([[0], np.cumsum(group_size)])
-    group_rank = utils.cal_group_rank(df['cscore_pr_run'].values, group_size_cumsum)
+    offsets = segment.get_offsets(df['pr_id'].values)
+    group_rank = segment.segment_rank(df['cscore_pr_run'].values, offsets)
     df['group_rank'] = group_rank
     df = df.loc[group_rank == 1]
 
@@ -166,11 +400,9 @@ def cal_q_pr_batch(df, batch_size, n_model, model_trained=None, scaler=None):
 
 @profile
 def cal_q_pr_first(df, batch_size, n_model):
-    col_idx = df.columns.str.startswith('score_')
-    logger.info('scores items: {}'.format(sum(col_idx)))
+    X, cols = features.get_score_matrix(df)
+    logger.info('scores items: {}'.format(len(cols)))
 
-    X = df.loc[:, col_idx].values
-    assert X.dtype == np.float32
     y = 1 - df['decoy'].values  # targets is positives
 
     # select by train_nn_type: 1-hard, 2-easy, 3-cross
@@ -182,23 +414,12 @@ def cal_q_pr_first(df, batch_size, n_model):
     info = 'Training the NN model: {} pos, {} neg'.format(n_pos, n_neg)
     logger.info(info)
 
-    param = (25, 20, 15, 10, 5)
-    mlps = [MLPClassifier(max_iter=1,
-                          shuffle=True,
-                          random_state=i,  # init weights and shuffle
-                          learning_rate_init=0.003,
-                          solver='adam',
-                          batch_size=batch_size,  # DIA-NN is 50
-                          activation='relu',
-                          hidden_layer_sizes=param) for i in range(n_model)]
-    names = [f'mlp{i}' for i in range(n_model)]
-    model = VotingClassifier(estimators=list(zip(names, mlps)),
-                             voting='soft',
-                             n_jobs=1 if __debug__ else n_model)
-    model.fit(X, y)
+    model = get_nn_model(n_model, batch_size)
+    with features.shared_matrix(X) as X:
+        model.fit(X, y)
 
-    # pred
-    cscore = model.predict_proba(X)[:, 1]
+        # pred
+        cscore = model.predict_proba(X)[:, 1]
     df['cscore_pr_run'] = cscore
 
     # mirrors does not involve this
@@ -207,11 +428,9 @@ def cal_q_pr_first(df, batch_size, n_model):
 
 
 def cal_q_pr_second(df_input, batch_size, n_model, cols_start='score_'):
-    col_idx = df_input.columns.str.startswith(cols_start)
-    logger.info('cols num: {}'.format(sum(col_idx)))
+    X, cols = features.get_score_matrix(df_input, cols_start)
+    logger.info('cols num: {}'.format(len(cols)))
 
-    X = df_input.loc[:, col_idx].values
-    assert X.dtype == np.float32
     y = 1 - df_input['decoy'].values  # targets is positives
 
     # select by train_nn_type: 1-hard, 2-easy, 3-cross
@@ -243,8 +462,9 @@ def cal_q_pr_second(df_input, batch_size, n_model, cols_start='score_'):
     model = VotingClassifier(estimators=list(zip(names, mlps)),
                              voting='soft',
                              n_jobs=1 if __debug__ else 12)
-    model.fit(X, y)
-    cscore = model.predict_proba(X)[:, 1]
+    with features.shared_matrix(X) as X:
+        model.fit(X, y)
+        cscore = model.predict_proba(X)[:, 1]
 
     df_input['cscore_pr_run'] = cscore
 
@@ -254,11 +474,9 @@ def cal_q_pr_second(df_input, batch_size, n_model, cols_start='score_'):
 
 
 def cal_q_pr_NN_NN(df_input, batch_size, n_model, cols_start='score_'):
-    col_idx = df_input.columns.str.startswith(cols_start)
-    logger.info('cols num: {}'.format(sum(col_idx)))
+    X, cols = features.get_score_matrix(df_input, cols_start)
+    logger.info('cols num: {}'.format(len(cols)))
 
-    X = df_input.loc[:, col_idx].values
-    assert X.dtype == np.float32
     y = 1 - df_input['decoy'].values  # targets is positives
 
     # select by train_nn_type: 1-hard, 2-easy, 3-cross
@@ -288,8 +506,9 @@ def cal_q_pr_NN_NN(df_input, batch_size, n_model, cols_start='score_'):
     model = VotingClassifier(estimators=list(zip(names, mlps)),
                              voting='soft',
                              n_jobs=1 if __debug__ else n_model)
-    model.fit(X_train, y_train)
-    preds = [clf.predict_proba(X_train)[:, 1] for clf in model.estimators_]
+    with features.shared_matrix(X_train) as X_train:
+        model.fit(X_train, y_train)
+        preds = [clf.predict_proba(X_train)[:, 1] for clf in model.estimators_]
     preds = np.array(preds).T
     meta = MLPClassifier(max_iter=1,
                           shuffle=True,
@@ -315,6 +534,17 @@ def cal_q_pr_NN_NN(df_input, batch_size, n_model, cols_start='score_'):
     return df
 
 
+def fit_fold(model, X2, y2, val_idx):
+    '''
+    Fit on the rows out of val_idx and predict val_idx. X2 is X stacked
+    twice, so the train rows of a contiguous fold are one slice of it.
+    '''
+    n = len(X2) // 2
+    start, end = val_idx[0], val_idx[-1] + 1
+    model.fit(X2[end:n + start], y2[end:n + start])
+    return model.predict_proba(X2[start:end])[:, 1]
+
+
 def cal_q_pr_kfold(df_input, batch_size, n_model, cols_start='score_'):
     df_input['cscore_pr_run'] = np.float32(0.)
 
@@ -322,47 +552,40 @@ def cal_q_pr_kfold(df_input, batch_size, n_model, cols_start='score_'):
     df_other = df_input[~df_input['is_main']].reset_index(drop=True)
     df_main = df_main.sample(frac=1, random_state=42).reset_index(drop=True)
 
-    col_idx = df_main.columns.str.startswith(cols_start)
-    logger.info('cols num: {}'.format(sum(col_idx)))
+    X, cols = features.get_score_matrix(df_main, cols_start)
+    logger.info('cols num: {}'.format(len(cols)))
 
-    X = df_main.loc[:, col_idx].values
-    assert X.dtype == np.float32
     y = 1 - df_main['decoy'].values  # targets is positives
     scaler = preprocessing.StandardScaler()
     X = scaler.fit_transform(X)
 
-    # k-folder
+    # k-folder, folds are fixed by the shuffle above
     k = 5
-    all_idx = np.arange(len(X))
-    cscore_v = []
-    for val_idx in np.array_split(all_idx, k):
-        train_idx = np.setdiff1d(all_idx, val_idx)
-        X_train = X[train_idx]
-        y_train = y[train_idx]
-        X_val = X[val_idx]
-
-        # training on group_rank == 1
-        n_pos, n_neg = sum(y_train == 1), sum(y_train == 0)
-        info = 'Training the model: {} pos, {} neg'.format(n_pos, n_neg)
-        logger.info(info)
-
-        # models
-        param = (25, 20, 15, 10, 5)
-        mlps = [MLPClassifier(max_iter=4,
-                              shuffle=True,
-                              random_state=i,  # init weights and shuffle
-                              learning_rate_init=0.003,
-                              solver='adam',
-                              batch_size=batch_size,  # DIA-NN is 50
-                              activation='relu',
-                              hidden_layer_sizes=param) for i in range(n_model)]
-        names = [f'mlp{i}' for i in range(n_model)]
-        model = VotingClassifier(estimators=list(zip(names, mlps)),
-                                 voting='soft',
-                                 n_jobs=1 if __debug__ else n_model)
-        model.fit(X_train, y_train)
+    val_idx_v = np.array_split(np.arange(len(X)), k)
+    n_pos, n_neg = sum(y == 1), sum(y == 0)
+    info = 'Training {}-fold models: {} pos, {} neg'.format(k, n_pos, n_neg)
+    logger.info(info)
 
-        cscore = model.predict_proba(X_val)[:, 1]
+    # folds in parallel, each with its share of the cores. [X; X] is shared
+    # once and the train rows of a fold are a view, not a copy per fold
+    n_fold_jobs = 1 if __debug__ else k
+    n_jobs = max(1, (os.cpu_count() or 1) // n_fold_jobs)
+    X2, y2 = np.concatenate([X, X]), np.concatenate([y, y])
+    del X
+    n_threads = torch.get_num_threads()
+    if param_g.is_fdr_torch:
+        torch.set_num_threads(n_jobs)
+    try:
+        with features.shared_matrix(X2) as X2:
+            cscore_v = Parallel(
+                n_jobs=n_fold_jobs,
+                prefer='threads' if param_g.is_fdr_torch else None
+            )(delayed(fit_fold)(
+                get_nn_model(n_model, batch_size, max_iter=4, n_jobs=n_jobs),
+                X2, y2, val_idx) for val_idx in val_idx_v)
+    finally:
+        torch.set_num_threads(n_threads)
+    for val_idx, cscore in zip(val_idx_v, cscore_v):
         df_main.loc[val_idx, 'cscore_pr_run'] = cscore
 
     # mirrors does not involve this
@@ -374,6 +597,7 @@ def cal_q_pr_kfold(df_input, batch_size, n_model, cols_start='score_'):
 
 
 def get_fake_decoy(df_decoy, n):
+    df_decoy = features.attach_spilled(df_decoy)
     df_fake = df_decoy.copy()
     df_fake = df_fake.sample(frac=1, random_state=42).reset_index(drop=True)
 
@@ -418,34 +642,36 @@ def cal_q_pr_fake(df_input, batch_size, n_model, cols_start='score_'):
     df_fake = get_fake_decoy(df_decoy, int(len(df_target) * 0.01))
     df_main = pd.concat([df_target, df_fake, df_decoy], axis=0, ignore_index=True)
 
-    col_idx = df_main.columns.str.startswith(cols_start)
-    logger.info('cols num: {}'.format(sum(col_idx)))
+    X, cols = features.get_score_matrix(df_main, cols_start)
+    logger.info('cols num: {}'.format(len(cols)))
 
-    X = df_main.loc[:, col_idx].values
-    assert X.dtype == np.float32
     y = 1 - df_main['decoy'].values  # targets is positives
     y[y < 0] = 1
     scaler = preprocessing.StandardScaler()
     X = scaler.fit_transform(X)
 
     # model
-    model = SoftVotingMLPEnsemble()
-    model.partial_fit(X, y)
-    cscore_best = model.predict_proba(X)[:, 1]
-    df_main['cscore_pr_run'] = cscore_best
-    ids_fake_best = sum(df_main.nlargest(ids_001, 'cscore_pr_run')['decoy'] == 2)
-    logger.info(ids_fake_best)
-    for i in range(5):
-        model.partial_fit(X, y)
-        cscore = model.predict_proba(X)[:, 1]
-        df_main['cscore_pr_run'] = cscore
-        ids_fake_now = sum(df_main.nlargest(ids_001, 'cscore_pr_run')['decoy'] == 2)
-        logger.info(ids_fake_now)
-        if ids_fake_now >= ids_fake_best:
-            break
+    with features.shared_matrix(X) as X:
+        if param_g.is_fdr_torch:
+            model = TorchMLPEnsemble(12, 50)
         else:
-            cscore_best = cscore
-            ids_fake_best = ids_fake_now
+            model = SoftVotingMLPEnsemble()
+        model.partial_fit(X, y)
+        cscore_best = model.predict_proba(X)[:, 1]
+        df_main['cscore_pr_run'] = cscore_best
+        ids_fake_best = sum(df_main.nlargest(ids_001, 'cscore_pr_run')['decoy'] == 2)
+        logger.info(ids_fake_best)
+        for i in range(5):
+            model.partial_fit(X, y)
+            cscore = model.predict_proba(X)[:, 1]
+            df_main['cscore_pr_run'] = cscore
+            ids_fake_now = sum(df_main.nlargest(ids_001, 'cscore_pr_run')['decoy'] == 2)
+            logger.info(ids_fake_now)
+            if ids_fake_now >= ids_fake_best:
+                break
+            else:
+                cscore_best = cscore
+                ids_fake_best = ids_fake_now
 
     df_main['cscore_pr_run'] = cscore_best
     df_main = df_main[df_main['decoy'] < 2].reset_index(drop=True)
@@ -466,43 +692,37 @@ def cal_q_pg(df_input_raw, q_pr_cut, run_or_global):
     df_na = df_input_raw[df_input_raw['cscore_pr_' + x].isna()]
     df_input = df_input_raw[~df_input_raw['cscore_pr_' + x].isna()]
 
-    if 'strip_seq' not in df_input.columns:
-        if 'simple_seq' not in df_input.columns:
-            df_input['simple_seq'] = df_input['pr_id'].str[:-1].replace(
-                ['C\(UniMod:4\)', 'M\(UniMod:35\)'], ['c', 'm'], regex=True
-            )
-        df_input['strip_seq'] = df_input['simple_seq'].str.upper()
+    is_id_input = 'strip_id' in df_input.columns
+    df_input['strip_id'] = seqid.get_seq_ids(df_input, 'strip_id')
 
-    # seq to strip_seq
-    df_pep_score = df_input[['strip_seq', 'cscore_pr_' + x]].copy()
-    idx_max = df_pep_score.groupby(['strip_seq'])['cscore_pr_' + x].idxmax()
-    df_pep_score = df_pep_score.loc[idx_max].reset_index(drop=True)
+    # seq to strip_id
+    df_pep_score = df_input[['strip_id', 'cscore_pr_' + x]].copy()
+    idx_max = segment.group_argmax(df_pep_score['strip_id'].values,
+                                   df_pep_score['cscore_pr_' + x].values)
+    df_pep_score = df_pep_score.iloc[idx_max].reset_index(drop=True)
 
     # row by protein group
     df = df_input[df_input['q_pr_' + x] < q_pr_cut]
-    df = df[['strip_seq', 'protein_group', 'decoy']]
+    df = df[['strip_id', 'protein_group', 'decoy']]
     df = df.drop_duplicates().reset_index(drop=True)
-    df = df.merge(df_pep_score, on='strip_seq')
-    df = df.groupby(by=['protein_group', 'decoy']).agg(
-        {
-            ('cscore_pr_' + x): lambda g: 1 - (1 - g).prod(),
-            # ('cscore_pr_' + x): lambda g: g.nlargest(1).sum(),
-            'strip_seq': lambda g: list(g)}
-    ).reset_index()
-    df = df.rename(columns={('cscore_pr_' + x): ('cscore_pg_' + x)})
+    df = df.merge(df_pep_score, on='strip_id')
+    # 1 - prod(1 - g) by a vectorized sum of logs
+    df['log_miss'] = np.log1p(-df['cscore_pr_' + x].values)
+    df = df.groupby(by=['protein_group', 'decoy'])['log_miss'].sum()
+    df = df.reset_index()
+    df['cscore_pg_' + x] = 1 - np.exp(df['log_miss'].values)
 
     # q
-    df = df.sort_values(by=('cscore_pg_' + x), ascending=False, ignore_index=True)
-    target_num = (df.decoy == 0).cumsum()
-    decoy_num = (df.decoy == 1).cumsum()
-    target_num[target_num == 0] = 1
-    df['q_pg_' + x] = decoy_num / target_num
-    df['q_pg_' + x] = df['q_pg_' + x][::-1].cummin()
+    order = qvalue.sort_desc(df['cscore_pg_' + x].values)
+    df = df.iloc[order].reset_index(drop=True)
+    df['q_pg_' + x] = qvalue.q_sorted(df['decoy'].values)
 
     df = df[['protein_group', 'decoy', 'cscore_pg_' + x, 'q_pg_' + x]]
 
     # return
     df_result = df_input.merge(df, on=['protein_group', 'decoy'], how='left')
+    if not is_id_input:
+        del df_result['strip_id']
     not_in_range = df_result['q_pg_' + x].isna()
     df_result.loc[not_in_range, 'cscore_pg_' + x] = 0.
     df_result.loc[not_in_range, 'q_pg_' + x] = 1
@@ -0,0 +1,379 @@
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from beta_dia import param_g
+from beta_dia import spill
+from beta_dia.log import Logger
+
+try:
+    # profile
+    profile = lambda x: x
+except:
+    profile = lambda x: x
+
+logger = Logger.get_logger()
+
+
+class ScoreMatrix():
+    '''
+    Preallocated float32 scores of a batch. Scorers write features into column
+    slots by names instead of inserting df columns one by one. The schema
+    (name -> slot, dtype) is registered in the first-write order and can be
+    passed to the next batch to allocate the exact width at once.
+    '''
+    def __init__(self, n, schema=None):
+        self.slots = {}
+        self.dtypes = {}
+        capacity = 64
+        if schema is not None:
+            self.slots = dict(schema.slots)
+            self.dtypes = dict(schema.dtypes)
+            capacity = max(len(self.slots), 1)
+        self.data = np.zeros((n, capacity), dtype=np.float32)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def names(self):
+        return list(self.slots)
+
+    def register(self, names, dtype):
+        for name in names:
+            if name not in self.slots:
+                self.slots[name] = len(self.slots)
+            self.dtypes[name] = dtype
+
+        # grow by doubling if not preallocated
+        if len(self.slots) > self.data.shape[1]:
+            capacity = max(len(self.slots), 2 * self.data.shape[1])
+            data = np.zeros((len(self), capacity), dtype=np.float32)
+            data[:, :self.data.shape[1]] = self.data
+            self.data = data
+
+        return [self.slots[name] for name in names]
+
+    def get_idx(self, idx):
+        # consecutive slots are a view
+        if len(idx) > 1 and idx[-1] - idx[0] == len(idx) - 1 and \
+                all(b - a == 1 for a, b in zip(idx[:-1], idx[1:])):
+            return slice(idx[0], idx[-1] + 1)
+        return idx[0] if len(idx) == 1 else idx
+
+    def __setitem__(self, names, values):
+        values = np.asarray(values)
+        is_single = isinstance(names, str)
+        names = [names] if is_single else list(names)
+        dtype = values.dtype if np.issubdtype(values.dtype, np.integer) \
+            else np.float32
+        idx = self.register(names, dtype)
+        if is_single:
+            self.data[:, idx[0]] = values
+        else:
+            self.data[:, self.get_idx(idx)] = values
+
+    def __getitem__(self, names):
+        if isinstance(names, str):
+            return self.data[:, self.slots[names]]
+        idx = [self.slots[name] for name in names]
+        return self.data[:, self.get_idx(idx)]
+
+    def __contains__(self, name):
+        return name in self.slots
+
+    def take(self, idx):
+        self.data = self.data[idx]
+
+    def to_df(self, index=None):
+        '''
+        Scores as a df in slot order. Integer features (e.g. spans, charges)
+        are cast back to their dtype, others stay float32.
+        '''
+        df = pd.DataFrame(self.data[:, :len(self.slots)],
+                          columns=self.names,
+                          index=index,
+                          copy=False)
+        cols_int = {k: v for k, v in self.dtypes.items() if v != np.float32}
+        if cols_int:
+            df = df.astype(cols_int)
+        return df
+
+    def attach_to(self, df):
+        '''
+        Concat scores to df by one pass. Existing columns with the same names
+        are replaced.
+        '''
+        cols_old = [name for name in self.slots if name in df.columns]
+        if cols_old:
+            df = df.drop(columns=cols_old)
+        return pd.concat([df, self.to_df(df.index)], axis=1)
+
+
+def get_score_cols(df, cols_start='score_', readers=None):
+    '''
+    Score columns of df and then the spilled ones, the column order of X.
+    '''
+    readers = spill.get_spill_readers(df) if readers is None else readers
+    cols = df.columns[df.columns.str.startswith(cols_start)].tolist()
+    for reader in readers:
+        cols += [col for col in reader.cols
+                 if col.startswith(cols_start) and col not in cols]
+    return pd.Index(cols)
+
+
+def get_score_matrix(df, cols_start='score_', chunk_cols=64, rows=None,
+                     readers=None):
+    '''
+    Score columns of df (rows of df if given) as one float32 matrix for FDR.
+    The matrix is filled by column chunks, so no df[cols] copy of all scores
+    is made. Columns spilled by ScoreSpill are read back for these rows,
+    readers can be built once by spill.get_spill_readers for many calls.
+    Returns:
+        X: [n, cols_num], float32
+        cols: the column names of X
+    '''
+    readers = spill.get_spill_readers(df) if readers is None else readers
+    cols = get_score_cols(df, cols_start, readers)
+    cols_df = cols[cols.isin(df.columns)]
+    n = len(df) if rows is None else len(rows)
+    X = np.empty((n, len(cols)), dtype=np.float32)
+    for i in range(0, len(cols_df), chunk_cols):
+        cols_chunk = cols_df[i : i + chunk_cols]
+        if rows is None:
+            X[:, i : i + len(cols_chunk)] = df[cols_chunk].to_numpy(np.float32)
+            continue
+        for j, col in enumerate(cols_chunk):
+            X[:, i + j] = df[col].to_numpy()[rows]
+
+    # spilled columns, missing rows (e.g. concat of runs) are NaN
+    X[:, len(cols_df):] = np.nan
+    for reader in readers:
+        cols_x = [col for col in reader.cols if col in cols]
+        spill_rows = df[reader.col_row].to_numpy()
+        spill_rows = spill_rows if rows is None else spill_rows[rows]
+        valid = np.flatnonzero(~pd.isna(spill_rows))
+        X[np.ix_(valid, cols.get_indexer(cols_x))] = reader.take(
+            spill_rows[valid].astype(np.int64), cols_x
+        )
+    return X, cols
+
+
+def attach_spilled(df):
+    '''
+    Spilled score columns back to df, for the ops that mix rows by values.
+    '''
+    readers = spill.get_spill_readers(df)
+    if len(readers) == 0:
+        return df
+    X, cols = get_score_matrix(df)
+    is_spilled = cols.isin([col for reader in readers for col in reader.cols])
+    cols_drop = [reader.col_row for reader in readers] + \
+                [col for col in cols[is_spilled] if col in df.columns]
+    df = df.drop(columns=cols_drop)
+    df_spilled = pd.DataFrame(X[:, is_spilled], columns=cols[is_spilled],
+                              index=df.index)
+    return pd.concat([df, df_spilled], axis=1)
+
+
+@contextmanager
+def shared_matrix(X):
+    '''
+    X as a read-only memmap in /dev/shm (or the temp dir) for joblib workers.
+    joblib pickles a memmap by its file name, so workers attach the pages
+    zero-copy instead of receiving X (or a fresh dump of it) on every call.
+    The caller should rebind its name, X in RAM is then released.
+    '''
+    # n_jobs is 1 in debug, no workers to share with
+    if not param_g.is_fdr_shm or __debug__:
+        yield X
+        return
+
+    folder = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    if folder is not None:
+        stat = os.statvfs(folder)
+        if stat.f_bavail * stat.f_frsize < X.nbytes:
+            folder = None # /dev/shm is small in containers
+    fd, fname = tempfile.mkstemp(prefix='beta_dia_', suffix='.mmap',
+                                 dir=folder)
+    os.close(fd)
+    try:
+        shape, dtype = X.shape, X.dtype
+        mm = np.memmap(fname, dtype=dtype, mode='w+', shape=shape)
+        mm[:] = X
+        mm.flush()
+        del mm, X
+        yield np.memmap(fname, dtype=dtype, mode='r', shape=shape)
+    finally:
+        os.remove(fname)
+
+
+class Family():
+    '''
+    A feature family of score_locus. func(ctx, sm) reads its inputs from ctx
+    and writes its outputs to sm. Core families are depended by others (e.g.
+    center elutions, spans) and can not be disabled. Tier-1 families are cheap
+    and run on all loci, tier-2 families only run on the screened loci.
+    '''
+    def __init__(self, name, func, inputs, outputs, cost, is_core=False,
+                 tier=1):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.cost = cost # 'low', 'mid' or 'high'
+        self.is_core = is_core
+        self.tier = tier
+
+
+# registered families in running order and the wall-time of families/inputs
+families = {}
+times = {}
+
+
+def register_family(name, func, inputs, outputs, cost, is_core=False,
+                    tier=1):
+    # the cheap tier screens before the deep inputs, it must stay cheap
+    if tier == 1 and cost != 'low':
+        raise ValueError(f'Tier-1 feature family should be low cost: {name}')
+    families[name] = Family(name, func, inputs, outputs, cost, is_core, tier)
+
+
+@contextmanager
+def timing(name):
+    t0 = time.perf_counter()
+    yield
+    times[name] = times.get(name, 0.) + time.perf_counter() - t0
+
+
+def check_families_off():
+    for name in param_g.score_families_off:
+        if name not in families:
+            logger.warning(f'Unknown feature family: {name}')
+        elif families[name].is_core:
+            logger.warning(f'Core feature family can not be disabled: {name}')
+
+
+def get_families_on():
+    families_off = set(param_g.score_families_off)
+    return [f for f in families.values()
+            if f.is_core or f.name not in families_off]
+
+
+def get_inputs_needed(tier=None):
+    return set(x for f in get_families_on() for x in f.inputs
+               if tier is None or f.tier == tier)
+
+
+def run_families(ctx, sm, tier=None):
+    '''
+    Run families of a tier (None for all) in order. Disabled families fill
+    their outputs by 0 to keep the column contract of FDR.
+    '''
+    families_on = get_families_on()
+    for family in families.values():
+        if tier is not None and family.tier != tier:
+            continue
+        if family in families_on:
+            with timing(family.name):
+                family.func(ctx, sm)
+        else:
+            sm[family.outputs] = np.float32(0.)
+
+
+def log_times():
+    '''
+    Wall-time of families/inputs, and the total of families by cost.
+    '''
+    info = ', '.join(f'{k}: {v:.1f}s' for k, v in
+                     sorted(times.items(), key=lambda x: -x[1]))
+    logger.info('Feature families time: ' + info)
+    cost_times = {}
+    for family in families.values():
+        if family.name in times:
+            cost_times[family.cost] = cost_times.get(family.cost, 0.) + \
+                                      times[family.name]
+    info = ', '.join(f'{k}: {v:.1f}s' for k, v in cost_times.items())
+    logger.info('Feature families time by cost: ' + info)
+    times.clear()
+
+
+class Screener():
+    '''
+    Fast screen by the cheap tier. The cut of the cheap score is calibrated by
+    the first screen_calib_num loci of a run. The ratio of false targets to
+    decoys (pi) is estimated below the 0.2 quantile of decoys where true
+    targets are rare. The cut is the highest decoy quantile at which the
+    estimated true targets below it, #target - pi * #decoy, do not exceed
+    screen_tp_loss of all. Loci before calibration are all kept.
+    '''
+    def __init__(self):
+        self.cut = None
+        self.scores_v, self.decoys_v = [], []
+        self.num_input, self.num_keep = 0, 0
+
+    @staticmethod
+    def cal_cheap_scores(sm):
+        # coelution, intensity similarity, rt and im bias
+        scores = sm['score_center_coelution'] + \
+                 sm['score_intensity_similarity'] + \
+                 sm['score_rt_ratio'] - \
+                 sm['score_imbias_average2'] / param_g.tol_im_xic
+        return scores
+
+    def calibrate(self):
+        scores = np.concatenate(self.scores_v)
+        decoys = np.concatenate(self.decoys_v)
+        self.scores_v, self.decoys_v = [], []
+        scores_t = np.sort(scores[decoys == 0])
+        scores_d = np.sort(scores[decoys == 1])
+        self.cut = -np.inf
+        if len(scores_d) == 0:
+            logger.info('Fast screen: no decoys, screen is off.')
+            return
+
+        cut_low = np.quantile(scores_d, 0.2)
+        pi = np.searchsorted(scores_t, cut_low) / \
+             max(np.searchsorted(scores_d, cut_low), 1)
+        tp_total = len(scores_t) - pi * len(scores_d)
+        if tp_total <= 0:
+            logger.info('Fast screen: no targets surplus, screen is off.')
+            return
+
+        for cut in np.quantile(scores_d, np.linspace(0.05, 0.95, 19)):
+            tp_lost = np.searchsorted(scores_t, cut) - \
+                      pi * np.searchsorted(scores_d, cut)
+            if tp_lost <= param_g.screen_tp_loss * tp_total:
+                self.cut = cut
+        ratio = np.searchsorted(scores_d, self.cut) / len(scores_d)
+        info = 'Fast screen: cheap score cut: {:.3f}, decoys rejected: {:.2f}'
+        logger.info(info.format(self.cut, ratio))
+
+    def screen(self, sm, decoys):
+        '''
+        Returns:
+            keep: bool array, the loci go to the tier-2
+        '''
+        scores = self.cal_cheap_scores(sm)
+        if self.cut is None:
+            self.scores_v.append(scores.copy())
+            self.decoys_v.append(decoys)
+            if sum(len(x) for x in self.scores_v) >= param_g.screen_calib_num:
+                self.calibrate()
+        keep = np.ones(len(scores), dtype=bool)
+        if self.cut is not None:
+            keep = scores >= self.cut
+        self.num_input += len(keep)
+        self.num_keep += keep.sum()
+        return keep
+
+    def log(self):
+        if self.num_input > 0:
+            info = 'Fast screen: {}/{} loci go to the deep tier'.format(
+                self.num_keep, self.num_input
+            )
+            logger.info(info)
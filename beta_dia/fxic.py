@@ -8,6 +8,7 @@ import torch.nn.functional as F
 from numba import cuda
 
 from beta_dia import param_g
+from beta_dia import segment
 from beta_dia import utils
 from beta_dia.log import Logger
 
@@ -351,7 +352,8 @@ def extract_xics(df,
                  cycle_num=None,
                  scope='center',
                  only_xic=False,
-                 by_pred=True):
+                 by_pred=True,
+                 im_mz_on_device=False):
     '''
     Extrac XICs from centroid ms data.
     Args:
@@ -365,6 +367,7 @@ def extract_xics(df,
         scope: which ions to consider
         only_xic:
         by_pred: use measure_im or pred_im
+        im_mz_on_device: keep ims and mzs on GPU for scope other than big
     Returns:
         cycles_idx, rts, ims, mzs, xics
     '''
@@ -418,14 +421,10 @@ def extract_xics(df,
         ms1_cols = ['pr_mz_left', 'pr_mz', 'pr_mz_1H', 'pr_mz_2H',
                     'pr_mz_left', 'pr_mz', 'pr_mz_1H', 'pr_mz_2H']  # unfrag
         ms1 = df[ms1_cols].values
-        cols_left = ['fg_mz_left_' + str(i) for i in range(param_g.fg_num)]
-        left = df[cols_left].values
-        cols_center = ['fg_mz_' + str(i) for i in range(param_g.fg_num)]
-        center = df[cols_center].values
-        cols_1H = ['fg_mz_1H_' + str(i) for i in range(param_g.fg_num)]
-        fg_1H = df[cols_1H].values
-        cols_2H = ['fg_mz_2H_' + str(i) for i in range(param_g.fg_num)]
-        fg_2H = df[cols_2H].values
+        left = utils.get_fg_mz_iso(df, -1)
+        center = utils.get_fg_mz_iso(df, 0)
+        fg_1H = utils.get_fg_mz_iso(df, 1)
+        fg_2H = utils.get_fg_mz_iso(df, 2)
         query_mz_m = np.concatenate([ms1, left, center, fg_1H, fg_2H], axis=1)
         ms1_ion_num = 4
     elif scope == 'top6':
@@ -484,6 +483,9 @@ def extract_xics(df,
         return (result_cycle_idx, result_rts, result_xic)
     else:
         if scope != 'big':
+            if im_mz_on_device:
+                return (result_cycle_idx, result_rts,
+                        result_im, result_mz, result_xic)
             return (
                 result_cycle_idx,
                 result_rts,
@@ -595,8 +597,9 @@ def screen_locus_by_deep(df_batch, locus_num, top_deep_q):
     condition1 = (group_rank_deep <= 2) | (group_rank_x <= 2)
 
     # screen by ratio
-    group_max = df_batch.groupby('pr_id')['seek_score_sa_x_deep'].transform('max')
-    ratios = df_batch['seek_score_sa_x_deep'] / group_max
+    x = df_batch['seek_score_sa_x_deep'].values
+    group_max = segment.segment_max(x, group_size_cumsum)
+    ratios = x / segment.broadcast(group_max, group_size_cumsum)
     condition2 = ratios > top_deep_q
 
     idx = condition1 & condition2
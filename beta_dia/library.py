@@ -1,10 +1,16 @@
+import hashlib
+import json
+import shutil
 import time
-import struct
 from pathlib import Path
-import multiprocessing as mp
 import numpy as np
 import pandas as pd
+import numba
+from numba import jit, prange
+from pyarrow import feather
 
+from beta_dia import param_g
+from beta_dia import seqid
 from beta_dia.log import Logger
 
 try:
@@ -15,256 +21,275 @@ except:
 
 logger = Logger.get_logger()
 
-def read_string(f):
-    size = f.read(4)
-    size = struct.unpack('<i', size)[0]
-    if size:
-        str = f.read(size)
-    else:
-        str = ''
-    return str
-
-
-def read_string_data(data, idx):
-    size, idx = read_int32_data(data, idx)
-    str = data[idx: (idx + size)]
-    idx += size
-    return str, idx
-
-
-def read_array_int(f):
-    size = f.read(4)
-    size = struct.unpack('<i', size)[0]
-    if size:
-        a = f.read(size * 4)
-        a = struct.unpack(str(size) + 'i', a)
-    else:
-        a = None
-    return a
-
-
-def read_int8(f):
-    x = f.read(1)
-    x = struct.unpack('b', x)[0]
+# fixed fields of an entry: the head at +0, fragments at +64
+entry_head_dtype = np.dtype([('index', '<i4'), ('charge', '<i4'),
+                             ('length', '<i4'), ('mz', '<f4'),
+                             ('irt', '<f4'), ('srt', '<f4'), ('x1', '<f4'),
+                             ('im', '<f4'), ('x2', '<f4')])
+entry_fg_dtype = np.dtype([('mz', '<f4'), ('height', '<f4'),
+                           ('charge', 'i1'), ('type', 'i1'),
+                           ('index', 'i1'), ('loss', 'i1')])
+entry_label = b'\x00\x00\x00\x00\x00\x00\x80?\x00\x00\x80?\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+@jit(nopython=True, nogil=True)
+def read_int32_buffer(buffer, idx):
+    x = np.int64(buffer[idx]) | (np.int64(buffer[idx + 1]) << 8) | \
+        (np.int64(buffer[idx + 2]) << 16) | (np.int64(buffer[idx + 3]) << 24)
+    if x >= 2 ** 31:
+        x -= 2 ** 32
     return x
 
 
-def read_int8_data(data, idx):
-    x = data[idx: (idx + 1)]
-    x = struct.unpack('b', x)[0]
-    idx += 1
-    return x, idx
-
-
-def read_int32(f):
-    x = f.read(4)
-    x = struct.unpack('<i', x)[0]
-    return x
-
-
-def read_int32_data(data, idx):
-    x = data[idx: (idx + 4)]
-    x = struct.unpack('<i', x)[0]
-    idx += 4
-    return x, idx
-
-
-def read_float64(f):
-    x = f.read(8)
-    x = struct.unpack('<d', x)[0]
-    return x
-
+@jit(nopython=True, nogil=True)
+def scan_entry_offsets(buffer, start, entry_num):
+    '''
+    Offsets of the .speclib entries. An entry is 172 + 24 * fg_num + len(pr_id)
+    bytes, fg_num is at +60 and len(pr_id) is at +144 + 24 * fg_num.
+    '''
+    offsets = np.empty(entry_num + 1, dtype=np.int64)
+    offset = start
+    for i in range(entry_num):
+        offsets[i] = offset
+        fg_num = read_int32_buffer(buffer, offset + 60)
+        id_len = read_int32_buffer(buffer, offset + 144 + 24 * fg_num)
+        offset += 172 + 24 * fg_num + id_len
+    offsets[entry_num] = offset
+    return offsets
+
+
+@jit(nopython=True, nogil=True, parallel=True)
+def gather_bytes(buffer, offsets, sizes, width):
+    '''
+    Rows of bytes from offsets, padded by 0 to the width.
+    '''
+    result = np.zeros((len(offsets), width), dtype=np.uint8)
+    for i in prange(len(offsets)):
+        result[i, :sizes[i]] = buffer[offsets[i] : offsets[i] + sizes[i]]
+    return result
+
+
+def gather_records(buffer, offsets, dtype):
+    sizes = np.full(len(offsets), dtype.itemsize, dtype=np.int64)
+    x = gather_bytes(buffer, offsets, sizes, dtype.itemsize)
+    return x.view(dtype)[:, 0]
+
+
+@jit(nopython=True, nogil=True)
+def scan_strings(buffer, idx, num):
+    '''
+    Offsets and lengths of num consecutive strings (int32 size + bytes).
+    '''
+    offsets = np.empty(num, dtype=np.int64)
+    lens = np.empty(num, dtype=np.int64)
+    for i in range(num):
+        lens[i] = read_int32_buffer(buffer, idx)
+        offsets[i] = idx + 4
+        idx += 4 + lens[i]
+    return offsets, lens, idx
+
+
+@jit(nopython=True, nogil=True)
+def scan_proteins(buffer, idx, num):
+    '''
+    A protein: sp, size, id, name, gene, name_index, gene_index and
+    precursors (int32 * size).
+    Returns:
+        starts: offsets of sp
+        sizes: precursors num
+        str_offsets, str_lens: [num, 3] for id, name and gene
+        tails: offsets of name_index
+    '''
+    starts = np.empty(num, dtype=np.int64)
+    sizes = np.empty(num, dtype=np.int64)
+    str_offsets = np.empty((num, 3), dtype=np.int64)
+    str_lens = np.empty((num, 3), dtype=np.int64)
+    tails = np.empty(num, dtype=np.int64)
+    for i in range(num):
+        starts[i] = idx
+        sizes[i] = read_int32_buffer(buffer, idx + 4)
+        idx += 8
+        for k in range(3):
+            str_lens[i, k] = read_int32_buffer(buffer, idx)
+            str_offsets[i, k] = idx + 4
+            idx += 4 + str_lens[i, k]
+        tails[i] = idx
+        idx += 8 + 4 * sizes[i]
+    return starts, sizes, str_offsets, str_lens, tails, idx
+
+
+@jit(nopython=True, nogil=True)
+def scan_protein_ids(buffer, idx, num):
+    '''
+    A protein ids: size, ids, names, genes, names_indices, genes_indices,
+    precursors (int32 arrays with size) and proteins (int32 * size).
+    Returns:
+        str_offsets, str_lens: [num, 3] for ids, names and genes
+        arr_offsets, arr_lens: [num, 4] for the three arrays and proteins
+    '''
+    str_offsets = np.empty((num, 3), dtype=np.int64)
+    str_lens = np.empty((num, 3), dtype=np.int64)
+    arr_offsets = np.empty((num, 4), dtype=np.int64)
+    arr_lens = np.empty((num, 4), dtype=np.int64)
+    for i in range(num):
+        size = read_int32_buffer(buffer, idx)
+        idx += 4
+        for k in range(3):
+            str_lens[i, k] = read_int32_buffer(buffer, idx)
+            str_offsets[i, k] = idx + 4
+            idx += 4 + str_lens[i, k]
+        for k in range(3):
+            arr_lens[i, k] = read_int32_buffer(buffer, idx)
+            arr_offsets[i, k] = idx + 4
+            idx += 4 + 4 * arr_lens[i, k]
+        arr_offsets[i, 3] = idx
+        arr_lens[i, 3] = size
+        idx += 4 * size
+    return str_offsets, str_lens, arr_offsets, arr_lens, idx
+
+
+def gather_strings(buffer, offsets, lens):
+    '''
+    Bytes of strings, '' for the empty.
+    '''
+    width = max(int(lens.max()) if len(lens) else 0, 1)
+    x = gather_bytes(buffer, offsets, lens, width)
+    x = pd.Series(x.view('S' + str(width))[:, 0].tolist(), dtype=object)
+    x[lens == 0] = ''
+    return x.values
+
+
+def gather_ints(buffer, offsets, lens, empty=None):
+    '''
+    int32 arrays by np.frombuffer-like gathers, the empty one is `empty`.
+    '''
+    rows = np.repeat(np.arange(len(lens)), lens)
+    ranks = np.arange(len(rows)) - np.repeat(np.cumsum(lens) - lens, lens)
+    values = gather_records(buffer, offsets[rows] + 4 * ranks,
+                            np.dtype('<i4'))
+    ends = np.cumsum(lens).tolist()
+    starts = [0] + ends[:-1]
+    result = np.empty(len(lens), dtype=object)
+    result[:] = [values[i:j] for i, j in zip(starts, ends)]
+    result[lens == 0] = empty
+    return result, values
+
+
+def read_head(buffer, idx):
+    head = np.frombuffer(buffer, dtype='<i4', count=4, offset=idx)
+    version, gen_decoy, gen_charge, infer_proteotypicity = head.tolist()
+    return (version, gen_decoy, gen_charge, infer_proteotypicity), idx + 16
+
+
+def read_strings(buffer, idx, num):
+    offsets, lens, idx = scan_strings(buffer, idx, num)
+    return gather_strings(buffer, offsets, lens), idx
+
+
+def read_proteins(buffer, idx):
+    protein_num = read_int32_buffer(buffer, idx)
+    starts, sizes, str_offsets, str_lens, tails, idx = scan_proteins(
+        buffer, idx + 4, protein_num
+    )
+    sp_v = gather_records(buffer, starts, np.dtype('<i4'))
+    indices = gather_records(buffer, tails, np.dtype([('name', '<i4'),
+                                                      ('gene', '<i4')]))
+    precursors_v, values = gather_ints(buffer, tails + 8, sizes)
+    assert values.min() >= 0
 
-def read_float32(f):
-    x = f.read(4)
-    x = struct.unpack('<f', x)[0]
-    return x
+    df = pd.DataFrame({
+        'protein.sp': sp_v.astype(np.int64),
+        'protein.id': gather_strings(buffer, str_offsets[:, 0], str_lens[:, 0]),
+        'protein.name': gather_strings(buffer, str_offsets[:, 1], str_lens[:, 1]),
+        'protein.gene': gather_strings(buffer, str_offsets[:, 2], str_lens[:, 2]),
+        'protein.name.index': indices['name'].astype(np.int64),
+        'protein.gene.index': indices['gene'].astype(np.int64),
+        'protein.precursors': precursors_v})
 
+    return df, idx
 
-def read_float32_data(data, idx):
-    x = data[idx: (idx + 4)]
-    x = struct.unpack('<f', x)[0]
-    idx += 4
-    return x, idx
-
-
-def read_head(f):
-    version = f.read(4)
-    version = struct.unpack('<i', version)[0]
-
-    gen_decoy = f.read(4)
-    gen_decoy = struct.unpack('<i', gen_decoy)[0]
-
-    gen_charge = f.read(4)
-    gen_charge = struct.unpack('<i', gen_charge)[0]
-
-    infer_proteotypicity = f.read(4)
-    infer_proteotypicity = struct.unpack('<i', infer_proteotypicity)[0]
-    return version, gen_decoy, gen_charge, infer_proteotypicity
-
-
-def read_proteins(f):
-    protein_num = read_int32(f)
-    sp_v, id_v, name_v, gene_v, name_index_v, gene_index_v, precursors_v = [], [], [], [], [], [], []
-    for i in range(protein_num):
-        sp = read_int32(f)
-        size = read_int32(f)
-        id = read_string(f)
-        name = read_string(f)
-        gene = read_string(f)
-        name_index = read_int32(f)
-        gene_index = read_int32(f)
-        precursors = [read_int32(f) for _ in range(size)]
-        assert min(precursors) >= 0
-
-        sp_v.append(sp)
-        id_v.append(id)
-        name_v.append(name)
-        gene_v.append(gene)
-        name_index_v.append(name_index)
-        gene_index_v.append(gene_index)
-        precursors_v.append(precursors)
-
-    df = pd.DataFrame({'protein.sp': sp_v,
-                       'protein.id': id_v,
-                       'protein.name': name_v,
-                       'protein.gene': gene_v,
-                       'protein.name.index': name_index_v,
-                       'protein.gene.index': gene_index_v,
-                       'protein.precursors': precursors_v})
 
-    return df
+# @profile
+def read_protein_ids(buffer, idx):
+    protein_ids_num = read_int32_buffer(buffer, idx)
+    str_offsets, str_lens, arr_offsets, arr_lens, idx = scan_protein_ids(
+        buffer, idx + 4, protein_ids_num
+    )
+    # only ids with proteins
+    good = arr_lens[:, 3] > 0
+    str_offsets, str_lens = str_offsets[good], str_lens[good]
+    arr_offsets, arr_lens = arr_offsets[good], arr_lens[good]
 
+    strs = [gather_strings(buffer, str_offsets[:, k], str_lens[:, k])
+            for k in range(3)]
+    arrs = [gather_ints(buffer, arr_offsets[:, k], arr_lens[:, k])
+            for k in range(4)]
+    if len(arrs[3][1]):
+        assert arrs[3][1].min() >= 0
 
-# @profile
-def read_protein_ids(f):
-    protein_ids_num = read_int32(f)
-    ids_v, names_v, genes_v, names_indices_v, genes_indices_v, proteins_v = [], [], [], [], [], []
-    precursors_v = []
-    for i in range(protein_ids_num):
-        size = read_int32(f)
-        ids = read_string(f)
-        names = read_string(f)
-        genes = read_string(f)
-        names_indices = read_array_int(f)
-        genes_indices = read_array_int(f)
-        precursors = read_array_int(f)
-        proteins = [read_int32(f) for _ in range(size)]
-        if size:
-            assert min(proteins) >= 0
-            ids_v.append(ids)
-            names_v.append(names)
-            genes_v.append(genes)
-            names_indices_v.append(names_indices)
-            genes_indices_v.append(genes_indices)
-            precursors_v.append(precursors)
-            proteins_v.append(proteins)
-
-    df = pd.DataFrame({'protein.ids': ids_v,
-                       'protein.ids.names': names_v,
-                       'protein.ids.genes': genes_v,
-                       'protein.ids.names.indices': names_indices_v,
-                       'protein.ids.genes.indices': genes_indices_v,
-                       'protein.ids.precursors': precursors_v,
-                       'protein.ids.proteins': proteins_v})
+    df = pd.DataFrame({'protein.ids': strs[0],
+                       'protein.ids.names': strs[1],
+                       'protein.ids.genes': strs[2],
+                       'protein.ids.names.indices': arrs[0][0],
+                       'protein.ids.genes.indices': arrs[1][0],
+                       'protein.ids.precursors': arrs[2][0],
+                       'protein.ids.proteins': arrs[3][0]})
 
-    return df
+    return df, idx
 
 
-def read_precursor_seq(f):
-    size = read_int32(f)
-    seq_v = [read_string(f) for _ in range(size)]
-    df = pd.DataFrame({'seq': seq_v})
-    return df
+def read_precursor_seq(buffer, idx):
+    size = read_int32_buffer(buffer, idx)
+    seq_v, idx = read_strings(buffer, idx + 4, size)
+    return pd.DataFrame({'seq': seq_v}), idx
 
 
-def read_name(f):
-    size = read_int32(f)
-    name_v = [read_string(f) for _ in range(size)]
-    df = pd.DataFrame({'name': name_v})
-    return df
+def read_name(buffer, idx):
+    size = read_int32_buffer(buffer, idx)
+    name_v, idx = read_strings(buffer, idx + 4, size)
+    return pd.DataFrame({'name': name_v}), idx
 
 
-def read_gene(f):
-    size = read_int32(f)
-    gene_v = [read_string(f) for _ in range(size)]
-    df = pd.DataFrame({'gene': gene_v})
-    return df
+def read_gene(buffer, idx):
+    size = read_int32_buffer(buffer, idx)
+    gene_v, idx = read_strings(buffer, idx + 4, size)
+    return pd.DataFrame({'gene': gene_v}), idx
 
 
 # @profile
-def read_entry_worker(binary_data, block_positions, block_label, worker_i):
-    start = block_positions[worker_i]
-    end = block_positions[worker_i + 1]
-    # adjust start and end
-    if worker_i > 0:
-        binary_data_right = binary_data[start:]
-        start = start + binary_data_right.find(block_label) + len(block_label)
-    if worker_i != (len(block_positions) - 2):
-        binary_data_right = binary_data[end:]
-        end = end + binary_data_right.find(block_label) + len(block_label)
-    block_data = binary_data[start: end]
-
-    pr_index_v, pr_charge_v, pr_length_v = [], [], []
-    pr_mz_v, pr_irt_v, pr_im_v = [], [], []
-    pr_id_v, pr_proteotypic_v = [], []
-    fg_num_v = []
-    fg_mz_v, fg_height_v, fg_charge_v = [], [], []
-    fg_type_v, fg_index_v, fg_loss_v = [], [], []
-
-    block_idx = 0
-
-    while block_idx < len(block_data):
-        index, charge, length, mz, irt, srt, x1, im, x2 = \
-            struct.unpack('3i6f', block_data[block_idx: (block_idx + 36)])
-        block_idx += 36
-        pr_index_v.append(index)
-        pr_charge_v.append(charge)
-        pr_length_v.append(length)
-        pr_mz_v.append(mz)
-        pr_irt_v.append(irt)
-        pr_im_v.append(im)
-
-        # x = struct.unpack('<6i', block_data[block_idx:(block_idx+24)])
-        block_idx += 24
-
-        fg_num, block_idx = read_int32_data(block_data, block_idx)
-        fg_num_v.append(fg_num)
-
-        fg = struct.unpack('2f4b' * fg_num,
-                           block_data[block_idx:(block_idx + 12 * fg_num)])
-        block_idx += (12 * fg_num)
-        fg_mz_v.extend(fg[::6])
-        fg_height_v.extend(fg[1::6])
-        fg_charge_v.extend(fg[2::6])
-        fg_type_v.extend(fg[3::6])
-        fg_index_v.extend(fg[4::6])
-        fg_loss_v.extend(fg[5::6])
-
-        # dc, entry_flag, pr_mz, pid_index = struct.unpack(
-        #     '<4i', block_data[block_idx:(block_idx + 16)]
-        # )
-        block_idx += 16
-        # assert dc == 0
-
-        # tmp = '<' + str(fg_num * 4) + 'f'
-        # xx = struct.unpack(tmp, block_data[block_idx:(block_idx+fg_num*4*4)])
-        block_idx += (fg_num+1)*4*4
-        block_idx += (12 - fg_num) * 4
-        pr_id, block_idx = read_string_data(block_data, block_idx)
-        pr_id_v.append(pr_id)
-
-        what = block_data[block_idx:(block_idx + 24)]
-        block_idx += 24
-        assert what == b'\x00\x00\x00\x00\x00\x00\x80?\x00\x00\x80?\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-
-    pr_index_v = np.array(pr_index_v, dtype=np.int32)
-    pr_charge_v = np.array(pr_charge_v, dtype=np.int8)
-    pr_length_v = np.array(pr_length_v, dtype=np.int8)
-    pr_mz_v = np.array(pr_mz_v, dtype=np.float32)
-    pr_irt_v = np.array(pr_irt_v, dtype=np.float32)
-    pr_im_v = np.array(pr_im_v, dtype=np.float32)
-    fg_num_v = np.array(fg_num_v, dtype=np.int8)
+def read_entries(buffer, start, entry_num):
+    '''
+    Entries by the offsets scan, then fixed fields are decoded by structured
+    dtypes over the buffer. pr_ids are gathered as a bytes array.
+    '''
+    offsets = scan_entry_offsets(buffer, start, entry_num)
+    offsets, ends = offsets[:-1], offsets[1:]
+
+    head = gather_records(buffer, offsets, entry_head_dtype)
+    pr_index_v = head['index'].astype(np.int32)
+    pr_charge_v = head['charge'].astype(np.int8)
+    pr_length_v = head['length'].astype(np.int8)
+    pr_mz_v = head['mz'].astype(np.float32)
+    pr_irt_v = head['irt'].astype(np.float32)
+    pr_im_v = head['im'].astype(np.float32)
+    fg_num_all = gather_records(buffer, offsets + 60, np.dtype('<i4'))
+    fg_num_v = fg_num_all.astype(np.int8)
+
+    # fragments of entries are consecutive 12 bytes
+    fg_starts = np.repeat(offsets + 64, fg_num_all)
+    fg_rank = np.arange(len(fg_starts)) - \
+              np.repeat(np.cumsum(fg_num_all) - fg_num_all, fg_num_all)
+    fg = gather_records(buffer, fg_starts + 12 * fg_rank, entry_fg_dtype)
+
+    # pr_id and the ending label
+    id_offsets = offsets + 148 + 24 * fg_num_all.astype(np.int64)
+    id_lens = ends - 24 - id_offsets
+    width = max(int(id_lens.max()) if len(id_lens) else 0, 1)
+    pr_id_v = gather_bytes(buffer, id_offsets, id_lens, width)
+    pr_id_v = pr_id_v.view('S' + str(width))[:, 0].astype(object)
+    labels = gather_records(buffer, ends - 24, np.dtype('V24'))
+    assert (labels == np.void(entry_label)).all()
+
     df = pd.DataFrame({'pr_id': pr_id_v,
                        'pr_index': pr_index_v,
                        'pr_charge': pr_charge_v,
@@ -274,25 +299,25 @@ def read_entry_worker(binary_data, block_positions, block_label, worker_i):
                        'pred_iim': pr_im_v,
                        'fg_num': fg_num_v,
                        })
-    assert sum(fg_loss_v) == 0, 'DIA-NN .speclib has fg_loss type!'
+    assert fg['loss'].sum() == 0, 'DIA-NN .speclib has fg_loss type!'
     assert len(df) == len(df.drop_duplicates(['pr_id', 'pr_index']))
     assert len(df) == df['pr_id'].nunique() == df['pr_index'].nunique()
 
     # unify to top-12，fg_anno code：y15_2 --> 2152
-    fg_mz_v = np.array(fg_mz_v, dtype=np.float32)
-    fg_height_v = np.array(fg_height_v, dtype=np.float32)
-    fg_type_v = np.array(fg_type_v, dtype=np.int16)  # b-1, y-2
-    fg_index_v = np.array(fg_index_v, dtype=np.int16) # from C-term
-    fg_charge_v = np.array(fg_charge_v, dtype=np.int16)
+    fg_mz_v = fg['mz'].astype(np.float32)
+    fg_height_v = fg['height'].astype(np.float32)
+    fg_type_v = fg['type'].astype(np.int16)  # b-1, y-2
+    fg_index_v = fg['index'].astype(np.int16) # from C-term
+    fg_charge_v = fg['charge'].astype(np.int16)
 
     y_index = fg_type_v == 2 # index -> len
     pr_length_vv = np.repeat(pr_length_v, fg_num_v)
     fg_index_v[y_index] = pr_length_vv[y_index] - fg_index_v[y_index]
 
-    assert fg_charge_v.max() < 10, 'fg_charge has to be less than 10!'
+    assert (fg_charge_v < 10).all(), 'fg_charge has to be less than 10!'
     fg_anno_v = fg_type_v * 1000 + fg_index_v * 10 + fg_charge_v
 
-    mask = np.arange(fg_num_v.max()) < fg_num_v[:, None]
+    mask = np.arange(fg_num_v.max(initial=0)) < fg_num_v[:, None]
     fg_mz = np.zeros(mask.shape, dtype=np.float32)
     fg_mz[mask] = fg_mz_v
     fg_height = np.zeros(mask.shape, dtype=np.float32)
@@ -311,49 +336,41 @@ def read_entry_worker(binary_data, block_positions, block_label, worker_i):
     return df
 
 
+# the compiled lib cache is rebuilt when its format changes
+lib_cache_version = 2
+
+
 # @profile
-def read_diann_speclib(file_path, worker_num):
-    with open(file_path, 'rb') as f:
-        version, gen_decoys, gen_charges, infer_proteotypicity = read_head(f)
-
-        name = read_string(f)
-        fasta_name = read_string(f)
-
-        df_protein = read_proteins(f)
-        df_protein_ids = read_protein_ids(f)
-        df_seq = read_precursor_seq(f)
-        df_name = read_name(f)
-        df_gene = read_gene(f)
-
-        irt_min = read_float64(f)
-        irt_max = read_float64(f)
-
-        entry_num = read_int32(f)
-        binary_data = f.read()
-
-    # last index
-    block_label = b'\x00\x00\x00\x00\x00\x00\x80?\x00\x00\x80?\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-    start = 0
-    end = binary_data.rfind(block_label) + len(block_label)
-
-    if worker_num > 1:
-        block_positions = np.linspace(start, end, worker_num + 1).astype(int)
-        pool = mp.Pool(worker_num)
-
-        results = [pool.apply_async(
-            read_entry_worker,
-            args=(binary_data, block_positions, block_label, i)
-        ) for i in range(worker_num)]
-        results = [r.get() for r in results]  # get
-        pool.close()
-        pool.join()
-
-        df_pr = pd.concat(results, ignore_index=True)
-    else: # main thread
-        block_positions = np.linspace(start, end, 2).astype(int)
-        df_pr = read_entry_worker(
-            binary_data, block_positions, block_label, 0
+def read_diann_speclib(file_path, worker_num=None):
+    # worker_num caps the numba threads of the parallel gathers
+    n_threads = numba.get_num_threads()
+    if worker_num is not None:
+        numba.set_num_threads(
+            max(1, min(worker_num, numba.config.NUMBA_NUM_THREADS))
         )
+    try:
+        # all sections are decoded over the memory-mapped file
+        buffer = np.asarray(np.memmap(file_path, dtype=np.uint8, mode='r'))
+        head, idx = read_head(buffer, 0)
+        version, gen_decoys, gen_charges, infer_proteotypicity = head
+
+        (name, fasta_name), idx = read_strings(buffer, idx, 2)
+
+        df_protein, idx = read_proteins(buffer, idx)
+        df_protein_ids, idx = read_protein_ids(buffer, idx)
+        df_seq, idx = read_precursor_seq(buffer, idx)
+        df_name, idx = read_name(buffer, idx)
+        df_gene, idx = read_gene(buffer, idx)
+
+        irt = np.frombuffer(buffer, dtype='<f8', count=2, offset=idx)
+        irt_min, irt_max = irt.tolist()
+        idx += 16
+
+        entry_num = read_int32_buffer(buffer, idx)
+        df_pr = read_entries(buffer, idx + 4, entry_num)
+        del buffer
+    finally:
+        numba.set_num_threads(n_threads)
 
     assert len(df_pr) == entry_num, 'Read .speclib ERROR!'
 
@@ -381,6 +398,55 @@ def read_diann_speclib(file_path, worker_num):
     )
 
 
+def get_lib_key(dir_lib):
+    '''
+    Hash of the lib file and the compiled format version.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    with open(dir_lib, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 24)
+            if not chunk:
+                break
+            h.update(chunk)
+    return '{}_v{}'.format(h.hexdigest(), lib_cache_version)
+
+
+def get_lib_cache_dir(dir_lib, key):
+    base = dir_lib.parent
+    if param_g.dir_lib_cache is not None:
+        base = Path(param_g.dir_lib_cache)
+    return base / '{}.compiled_{}'.format(dir_lib.stem, key)
+
+
+def compile_lib(df_lib):
+    '''
+    Run-independent polish of prs, row-wise so it can be done once for the
+    whole lib and cached: simple_seq, bad_seq (BJOUXZ), interned seq ids,
+    pred_im and isotopes.
+    '''
+    df_lib['simple_seq'] = df_lib['pr_id'].str[:-1].replace(
+        ['C\(UniMod:4\)', 'M\(UniMod:35\)'], ['c', 'm'], regex=True
+    )
+    bad_idx = df_lib['simple_seq'].str.contains('[BJOUXZ]', regex=True)
+    df_lib['bad_seq'] = bad_idx.values
+    df_lib = seqid.add_seq_ids(df_lib, is_overwrite=True)
+
+    # pred_im
+    df_lib['pred_im'] = df_lib['pred_iim']
+
+    # pr_mz_iso
+    mass_neutron = 1.0033548378
+    pr_mass = df_lib['pr_mz'] * df_lib['pr_charge']
+    pr_mz_1H = (pr_mass + mass_neutron) / df_lib['pr_charge']
+    pr_mz_2H = (pr_mass + 2 * mass_neutron) / df_lib['pr_charge']
+    pr_mz_left = (pr_mass - mass_neutron) / df_lib['pr_charge']
+    df_lib['pr_mz_1H'] = pr_mz_1H.astype(np.float32)
+    df_lib['pr_mz_2H'] = pr_mz_2H.astype(np.float32)
+    df_lib['pr_mz_left'] = pr_mz_left.astype(np.float32)
+    return df_lib
+
+
 class Library():
 
     # @profile
@@ -389,6 +455,15 @@ class Library():
         logger.info('Loading lib: ' + dir_lib.name)
         t0 = time.time()
         self.lib_type = dir_lib.suffix
+        self.dir_compiled = None
+
+        if param_g.is_lib_cache or param_g.is_lib_shared:
+            key = get_lib_key(dir_lib)
+            dir_cache = get_lib_cache_dir(dir_lib, key)
+            if (dir_cache / 'meta.json').exists():
+                self.load_compiled(dir_cache)
+                logger.info(f'Lib prs: {len(self.df_pr)}, compiled: {key}')
+                return
 
         # parquet
         if self.lib_type == '.parquet':
@@ -404,7 +479,8 @@ class Library():
                 version, name, fasta_name,
                 df_protein, df_protein_ids, df_seq, df_name, df_gene,
                 df_pr
-            ) = read_diann_speclib(dir_lib, worker_num=1 if __debug__ else 8)
+            ) = read_diann_speclib(dir_lib,
+                                  worker_num=1 if __debug__ else 8)
             assert version == -8, '.speclib is not from DIA-NN-1.9/1.9.1!'
 
             self.df_protein = df_protein
@@ -417,6 +493,78 @@ class Library():
         assert len(self.df_pr) == self.df_pr['pr_id'].nunique()
         logger.info(f'Lib prs: {len(self.df_pr)}')
 
+        if param_g.is_lib_cache or param_g.is_lib_shared:
+            self.df_pr = compile_lib(self.df_pr)
+            self.save_compiled(dir_cache, key)
+            # drop the private copy and attach the compiled one
+            if param_g.is_lib_shared and (dir_cache / 'meta.json').exists():
+                self.load_compiled(dir_cache)
+
+    @classmethod
+    def from_compiled(cls, dir_cache, is_shared=None):
+        lib = cls.__new__(cls)
+        lib.load_compiled(Path(dir_cache), is_shared)
+        return lib
+
+    def __reduce__(self):
+        # a shared lib is pickled to workers by its path, they attach it
+        if param_g.is_lib_shared and self.dir_compiled is not None:
+            return Library.from_compiled, (str(self.dir_compiled), True)
+        return super().__reduce__()
+
+    def get_tables(self):
+        if self.lib_type == '.parquet':
+            return {'df_map': self.df_map}
+        return {'df_protein': self.df_protein,
+                'df_protein_ids': self.df_protein_ids,
+                'df_seq': self.df_seq,
+                'df_name': self.df_name,
+                'df_gene': self.df_gene}
+
+    def save_compiled(self, dir_cache, key):
+        '''
+        df_pr as uncompressed Arrow (feather) to be memory-mapped, the small
+        protein tables as a pickle. Written to a temp folder then renamed, a
+        broken cache is never loaded.
+        '''
+        dir_tmp = dir_cache.with_name(dir_cache.name + '.tmp')
+        try:
+            shutil.rmtree(dir_tmp, ignore_errors=True)
+            dir_tmp.mkdir(parents=True)
+            self.df_pr.to_feather(dir_tmp / 'pr.feather',
+                                  compression='uncompressed')
+            pd.to_pickle(self.get_tables(), dir_tmp / 'tables.pkl')
+            meta = {'key': key, 'lib_type': self.lib_type,
+                    'pr_num': len(self.df_pr)}
+            with open(dir_tmp / 'meta.json', 'w') as f:
+                json.dump(meta, f, indent=2)
+            shutil.rmtree(dir_cache, ignore_errors=True)
+            dir_tmp.rename(dir_cache)
+            logger.info(f'Lib is compiled: {dir_cache}')
+        except OSError as e:
+            shutil.rmtree(dir_tmp, ignore_errors=True)
+            logger.warning(f'Lib can not be compiled: {e}')
+
+    def load_compiled(self, dir_cache, is_shared=None):
+        '''
+        If is_lib_shared, numeric columns of df_pr stay as read-only views of
+        the mapped file (split_blocks, no consolidation), so processes on a
+        node share the page cache of one copy. dir_lib_cache in /dev/shm keeps
+        it in RAM. Strings are still copied per process. The views are
+        read-only, so writers copy the rows they modify, see
+        polish_lib_by_swath.
+        '''
+        with open(dir_cache / 'meta.json', 'r') as f:
+            meta = json.load(f)
+        self.lib_type = meta['lib_type']
+        table = feather.read_table(dir_cache / 'pr.feather', memory_map=True)
+        if is_shared is None:
+            is_shared = param_g.is_lib_shared
+        self.df_pr = table.to_pandas(split_blocks=is_shared)
+        self.dir_compiled = dir_cache
+        for name, df in pd.read_pickle(dir_cache / 'tables.pkl').items():
+            setattr(self, name, df)
+
     def __len__(self):
         return len(self.df_pr)
 
@@ -524,36 +672,25 @@ class Library():
         pr_mz = df_lib['pr_mz'].values
         pr_mz_min, pr_mz_max = swath[0], swath[-1]
         good_idx = (pr_mz > pr_mz_min) & (pr_mz < pr_mz_max)
-        df_lib = df_lib.iloc[good_idx].reset_index(drop=True)
+        # own copy, df_pr may be read-only views of the compiled lib
+        df_lib = df_lib.iloc[good_idx].reset_index(drop=True).copy()
 
         # drop duplicates
         df_lib = df_lib.drop_duplicates(subset='pr_id', ignore_index=True)
         assert len(df_lib) == df_lib.pr_id.nunique()
 
+        # simple_seq, pred_im and isotopes, done if the lib is compiled
+        if 'bad_seq' not in df_lib.columns:
+            df_lib = compile_lib(df_lib)
+
         # remove BJOUXZ
-        df_lib['simple_seq'] = df_lib['pr_id'].str[:-1].replace(
-            ['C\(UniMod:4\)', 'M\(UniMod:35\)'], ['c', 'm'], regex=True
-        )
-        bad_idx = df_lib['simple_seq'].str.contains('[BJOUXZ]', regex=True)
+        bad_idx = df_lib.pop('bad_seq').values
         df_lib = df_lib[~bad_idx].reset_index(drop=True)
 
         # fg_num >= 4
         df_lib = df_lib[df_lib.fg_num >= 4]
         df_lib = df_lib.reset_index(drop=True)
 
-        # pred_im
-        df_lib['pred_im'] = df_lib['pred_iim']
-
-        # pr_mz_iso
-        mass_neutron = 1.0033548378
-        pr_mass = df_lib['pr_mz'] * df_lib['pr_charge']
-        pr_mz_1H = (pr_mass + mass_neutron) / df_lib['pr_charge']
-        pr_mz_2H = (pr_mass + 2 * mass_neutron) / df_lib['pr_charge']
-        pr_mz_left = (pr_mass - mass_neutron) / df_lib['pr_charge']
-        df_lib['pr_mz_1H'] = pr_mz_1H.astype(np.float32)
-        df_lib['pr_mz_2H'] = pr_mz_2H.astype(np.float32)
-        df_lib['pr_mz_left'] = pr_mz_left.astype(np.float32)
-
         # assign swath_id
         swath_id = np.digitize(df_lib['pr_mz'].values, swath)
         df_lib['swath_id'] = swath_id.astype(np.int8)
@@ -573,10 +710,12 @@ class Library():
 
     def polish_lib_by_targets(self, pr_targets):
         self.df_pr = self.df_pr[self.df_pr['pr_id'].isin(pr_targets)]
+        self.dir_compiled = None # differs from the compiled now
         logger.info(f'Polishing spectral library: {len(self.df_pr)} prs')
 
     def polish_lib_by_idx(self, prs_idx):
         self.df_pr = self.df_pr[self.df_pr['pr_index'].isin(prs_idx)]
+        self.dir_compiled = None # differs from the compiled now
         logger.info(f'Polishing spectral library: {len(self.df_pr)} prs')
 
     def assign_proteins(self, df):
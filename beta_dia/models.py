@@ -1,3 +1,5 @@
+import time
+
 import torch
 import torch.nn as nn
 from torch.nn.utils.rnn import PackedSequence
@@ -76,7 +78,10 @@ class DeepMap(nn.Module):
         self.fc2 = nn.Linear(in_features=nn_out_features, out_features=2)
 
     # @profile
-    def forward(self, maps, batch_valid_num):
+    def forward_feature(self, maps, batch_valid_num):
+        '''
+        The frozen part when refining. feature_all is the input of fc1.
+        '''
         # two normalization methods
         e = 1e-7
         maps_elution = maps / (torch.amax(maps, dim=(2, 3), keepdim=True) + e)
@@ -109,12 +114,22 @@ class DeepMap(nn.Module):
         feature_map = torch.cat([maps_elution, maps_ratio], dim=1)
         feature_all = torch.cat([embed, maps_elution, maps_ratio], dim=1)
 
+        return feature_map, feature_all
+
+    def forward_head(self, feature_all):
         # class
         x = self.fc1(feature_all)
         x = self.relu(x)
         x = self.dropout(x)
         result = self.fc2(x)
 
+        return result
+
+    # @profile
+    def forward(self, maps, batch_valid_num):
+        feature_map, feature_all = self.forward_feature(maps, batch_valid_num)
+        result = self.forward_head(feature_all)
+
         return feature_map, result
 
 
@@ -142,6 +157,97 @@ class DeepMall(nn.Module):
         self.relu = nn.ReLU()
         self.fc2 = nn.Linear(feature_dim, 2)
 
+        # forward_padded is used if equal to forward and faster, checked on
+        # the first batch
+        self.is_padded_ok = None
+
+    def gru_direction(self, x, mask, layer, reverse):
+        '''
+        One direction of a layer of xic_gru over padded sequences.
+        Steps out of the valid length keep h unchanged, which gives the same
+        outputs as the packed sequences on valid steps.
+        Args:
+            x: [batch_size, max_lens, in_dim]
+            mask: [batch_size, max_lens]
+        '''
+        suffix = '_l{}{}'.format(layer, '_reverse' if reverse else '')
+        w_ih = getattr(self.xic_gru, 'weight_ih' + suffix)
+        w_hh = getattr(self.xic_gru, 'weight_hh' + suffix)
+        b_ih = getattr(self.xic_gru, 'bias_ih' + suffix)
+        b_hh = getattr(self.xic_gru, 'bias_hh' + suffix)
+
+        # input gates of all steps by one matmul
+        gates_x = torch.nn.functional.linear(x, w_ih, b_ih)
+        gates_x = gates_x.chunk(3, dim=2)
+
+        steps = range(x.shape[1] - 1, -1, -1) if reverse else range(x.shape[1])
+        h = x.new_zeros(x.shape[0], w_hh.shape[1])
+        outputs = [None] * x.shape[1]
+        for t in steps:
+            h_r, h_z, h_n = torch.nn.functional.linear(h, w_hh, b_hh).chunk(3, 1)
+            r = torch.sigmoid(gates_x[0][:, t] + h_r)
+            z = torch.sigmoid(gates_x[1][:, t] + h_z)
+            n = torch.tanh(gates_x[2][:, t] + r * h_n)
+            h_new = (1 - z) * n + z * h
+            h = torch.where(mask[:, t:(t + 1)], h_new, h)
+            outputs[t] = h
+        return torch.stack(outputs, dim=1)
+
+    def forward_padded(self, batch_mall, batch_valid_num):
+        '''
+        Fixed-length masked path: no packing, no host sync and no re-sorting.
+        Equal to forward, see check_padded.
+        '''
+        batch_mall = batch_mall.permute((0, 2, 1))
+        max_lens = batch_mall.shape[1]
+        steps = torch.arange(max_lens, device=batch_mall.device)
+        mask = steps < batch_valid_num.view(-1, 1) # [batch_size, max_lens]
+
+        outputs = batch_mall
+        for layer in range(self.xic_gru.num_layers):
+            outputs = torch.cat([
+                self.gru_direction(outputs, mask, layer, reverse=False),
+                self.gru_direction(outputs, mask, layer, reverse=True)
+            ], dim=2)
+
+        # attention, the max is over valid steps as the packed
+        att_w = torch.tanh(self.attention(outputs))
+        att_w = self.context(att_w).squeeze(2)  # [batch_size, max_lens]
+        att_w = att_w.masked_fill(~mask, float('-inf'))
+        att_w = torch.exp(att_w - att_w.max())
+        alphas = att_w / torch.sum(att_w, dim=1, keepdim=True)
+        outputs = outputs.masked_fill(~mask.unsqueeze(2), 0.)
+        outputs = (outputs * alphas.unsqueeze(2)).sum(dim=1)
+
+        # fc
+        feature = self.fc1(outputs)
+        result = self.fc2(self.relu(feature))
+
+        return feature, result
+
+    def check_padded(self, batch_mall, batch_valid_num, atol=1e-4):
+        '''
+        Whether forward_padded gives the same feature and pred as forward,
+        and whether it is faster on this batch (the second run of each).
+        Returns:
+            is_equal, is_faster
+        '''
+        outputs, times = [], []
+        for func in [self.forward, self.forward_padded]:
+            for _ in range(2):
+                t0 = time.perf_counter()
+                with torch.no_grad():
+                    output = func(batch_mall, batch_valid_num)
+                if batch_mall.is_cuda:
+                    torch.cuda.synchronize()
+                t = time.perf_counter() - t0
+            outputs.append(output)
+            times.append(t)
+        (feature, result), (feature_p, result_p) = outputs
+        is_equal = (torch.allclose(feature, feature_p, atol=atol) and
+                    torch.allclose(result, result_p, atol=atol))
+        return is_equal, times[1] < times[0]
+
     # @profile
     def forward(self, batch_mall, batch_valid_num):
         batch_mall = batch_mall.permute((0, 2, 1))
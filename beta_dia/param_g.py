@@ -13,6 +13,24 @@ locus_rt_thre = None # second
 gpu_id = None
 is_overwrite = False
 
+# compiled library cache keyed on the hash of the lib file
+is_lib_cache = False
+dir_lib_cache = None # None means the folder of the lib
+# compiled lib is attached zero-copy by processes, e.g. dir_lib_cache=/dev/shm
+is_lib_shared = False
+# fragment isotope m/z are generated on demand, not as 36 df columns
+is_fg_iso_lazy = False
+
+# m/z calib as a correction table applied when copying a swath to GPU,
+# instead of rewriting the m/z of all maps in host memory
+is_mz_calib_lazy = False
+
+# IM/m/z calib by LOWESS on a stratified sample of seeds, checked by the
+# held-out seeds and refit on all seeds if their residuals disagree
+is_calib_sample = False
+calib_sample_num = 5000
+calib_sample_tol = 0.1
+
 # tol_rt is related to the length of gradient
 tol_rt_ratio = 1/15
 sample_ratio = 0.1 # sample for calculate tolerances
@@ -22,6 +40,13 @@ locus_valid_num = 3.5
 top_sa_cut, top_deep_cut = 0.75, 0.66
 # batch size max for targets; when low memory mode, it's 250000
 target_batch_max = 450000
+# FDR by the out-of-core NN: running scaler, partial_fit and chunk-wise pred
+is_fdr_stream = False
+fdr_chunk_rows = 200000
+# FDR NN members trained as one batched torch network instead of sklearn
+is_fdr_torch = False
+# X of the joblib FDR workers is a memmap in /dev/shm instead of pickled
+is_fdr_shm = False
 # batch q cut
 rubbish_q_cut = 0.5
 
@@ -42,6 +67,34 @@ window_points = 7 # SA only using 7 cycles.
 
 # deepmap retrain or deepmall train
 patient = 5
+# refined models are cached by instrument, gradient and window scheme
+is_model_cache = False
+dir_model_cache = None # None means dir_out_global/models
+model_cache_acc_tol = 0.01 # cached acc drops more than this, retrain
+# DeepMall inference by the padded masked GRU instead of packed sequences,
+# used only if equal and faster on the first batch (GPU: no host sync/sort;
+# CPU: packed is ~2x faster), see deepmall.bench_mall_padded
+is_mall_padded = False
+# cohort refine: runs in multi_ws pool samples and share one refined model
+is_cohort_refine = False
+# a run gives at most 10000 pos (extract_map_by_compare), so one run with
+# full ids reaches cohort_pos_min and runs with less ids are pooled
+cohort_sample_num = 20000 # max samples pooled from each run, half pos
+cohort_pos_min = 10000 # pooled pos reaches this, the shared model is fixed
+cohort = None # refine.Cohort of multi_ws, set by init_multi_ws
+
+# feature families of score_locus disabled for fast screening, e.g. ['ft_pre']
+# their columns are filled by 0 to keep the 392 columns for FDR
+score_families_off = []
+
+# spill the deep features (score_ft_*) of each swath to parquet, lower the
+# peak RAM. FDR reads them back by chunk rows
+is_spill_scores = False
+
+# fast screen: the cheap tier rejects loci before DeepMap and ppm XICs
+is_fast_screen = False
+screen_calib_num = 20000 # loci to calibrate the cut of cheap score
+screen_tp_loss = 0.01 # estimated true targets lost by the cut
 
 # global
 top_k_fg = 5 # select top_k_fg ions for cross quantification of precursors
@@ -4,6 +4,8 @@ from numba import jit
 
 from beta_dia.log import Logger
 from beta_dia import param_g
+from beta_dia import segment
+from beta_dia import seqid
 from beta_dia import utils
 
 logger = Logger.get_logger()
@@ -76,11 +78,10 @@ def polish_prs(df_input, tol_im=0.03, tol_ppm=20, tol_sa_ratio=0.75, tol_share_n
         target_num_before = len(df_target)
 
         # process I/L peptideform
-        df_target['pr_IL'] = df_target['pr_id'].replace(['I', 'L'], ['x', 'x'], regex=True)
-        idx_max = df_target.groupby('pr_IL')['cscore_pr_run'].idxmax()
+        idx_max = segment.group_argmax(seqid.get_seq_ids(df_target, 'il_id'),
+                                       df_target['cscore_pr_run'].values)
         polish_IL_num = len(df_target) - len(idx_max)
-        df_target = df_target.loc[idx_max].reset_index(drop=True)
-        del df_target['pr_IL']
+        df_target = df_target.iloc[idx_max].reset_index(drop=True)
 
         # tol_locus is from the half of span
         spans = df_target.loc[df_target['q_pr_run'] < 0.01, 'score_elute_span']
@@ -147,11 +148,10 @@ def polish_prs_in_reanalysis(df_input, tol_im, tol_ppm, tol_sa_ratio, tol_share_
     target_num_before = len(df_target)
 
     # process I/L peptideform
-    df_target['pr_IL'] = df_target['pr_id'].replace(['I', 'L'], ['x', 'x'], regex=True)
-    idx_max = df_target.groupby('pr_IL')['cscore_pr_run'].idxmax()
+    idx_max = segment.group_argmax(seqid.get_seq_ids(df_target, 'il_id'),
+                                   df_target['cscore_pr_run'].values)
     polish_IL_num = len(df_target) - len(idx_max)
-    df_target = df_target.loc[idx_max].reset_index(drop=True)
-    del df_target['pr_IL']
+    df_target = df_target.iloc[idx_max].reset_index(drop=True)
 
     # tol_locus is from the half of span
     spans = df_target.loc[df_target['q_pr_run'] < 0.01, 'score_elute_span']
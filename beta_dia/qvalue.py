@@ -0,0 +1,33 @@
+import numpy as np
+
+'''
+Target-decoy q values on arrays. decoys: 0 for targets, 1 for decoys, others
+(e.g. fake decoys) are not counted.
+'''
+
+
+def sort_desc(scores):
+    '''
+    Row order by scores descending, ties by row order, NaN goes last.
+    '''
+    return np.argsort(-np.asarray(scores), kind='stable')
+
+
+def q_sorted(decoys):
+    '''
+    q values of rows already sorted by scores descending.
+    '''
+    decoys = np.asarray(decoys)
+    decoy_num = np.cumsum(decoys == 1)
+    target_num = np.maximum(np.cumsum(decoys == 0), 1)
+    q = decoy_num / target_num
+    return np.minimum.accumulate(q[::-1])[::-1]
+
+
+def num_at(q, q_cuts):
+    '''
+    Numbers of the leading rows with q < q_cuts, all cuts by one vectorized
+    search. Rows are sorted once by sort_desc, so q is non-decreasing and
+    the rows of each cut are a prefix.
+    '''
+    return np.searchsorted(np.asarray(q), q_cuts, side='left')
@@ -1,4 +1,7 @@
 import copy
+import hashlib
+import json
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
@@ -276,26 +279,103 @@ def train_one_epoch(trainloader, model, optimizer, loss_fn):
     return epoch_loss
 
 
+@profile
+def extract_map_features(model_maps, maps, valid_nums, batch_size=1000):
+    '''
+    Features of the frozen part of DeepMap, i.e. the inputs of fc1.
+    Returns:
+        [n, 3 * nn_out_features] on cpu
+    '''
+    device = param_g.gpu_id
+    model_maps.eval()
+    feature_v = []
+    for i in range(0, len(maps), batch_size):
+        batch_map = torch.from_numpy(maps[i: i + batch_size])
+        batch_map = batch_map.float().to(device)
+        batch_map_len = torch.from_numpy(valid_nums[i: i + batch_size])
+        batch_map_len = batch_map_len.long().to(device)
+        with torch.no_grad():
+            _, feature_all = model_maps.forward_feature(batch_map,
+                                                        batch_map_len)
+        feature_v.append(feature_all.cpu())
+    return torch.cat(feature_v)
+
+
+def eval_one_epoch_head(trainloader, model):
+    device = param_g.gpu_id
+    model.eval()
+    prob_v, label_v = [], []
+
+    for batch_idx, (batch_feature, batch_y) in enumerate(trainloader):
+        batch_feature = batch_feature.to(device)
+        with torch.no_grad():
+            prob = model.forward_head(batch_feature)
+        prob = torch.softmax(prob.view(-1, 2), 1)
+        prob_v.extend(prob[:, 1].tolist())
+        label_v.extend(batch_y.tolist())
+
+    prob_v = np.array(prob_v)
+    label_v = np.array(label_v)
+    acc = sum((prob_v >= 0.5) == label_v) / len(label_v)
+    return acc
+
+
+def train_one_epoch_head(trainloader, model, optimizer, loss_fn):
+    device = param_g.gpu_id
+    model.train()
+    epoch_loss = 0.
+    for batch_idx, (batch_feature, batch_y) in enumerate(trainloader):
+        batch_feature = batch_feature.to(device)
+        batch_y = batch_y.long().to(device)
+
+        batch_pred = model.forward_head(batch_feature)
+        batch_loss = loss_fn(batch_pred, batch_y)
+
+        optimizer.zero_grad()
+        batch_loss.backward()
+        optimizer.step()
+
+        epoch_loss += batch_loss.item()
+
+    epoch_loss = epoch_loss / (batch_idx + 1)
+    return epoch_loss
+
+
 def retrain_model_map(model_maps, maps, valid_nums, labels, maps_type, epochs):
+    '''
+    Only fc1 and fc2 are refined. The frozen features are computed once and
+    the head is trained on them, so the convs run one pass instead of epochs.
+    '''
     batch_size = 64
     num_workers = 0
 
-    train_dataset, eval_dataset = make_dataset_maps(
-        maps, valid_nums, labels, train_ratio=0.9, maps_type=maps_type
+    features = extract_map_features(model_maps, maps, valid_nums)
+    dataset = torch.utils.data.TensorDataset(
+        features, torch.from_numpy(np.asarray(labels))
     )
+    # same split as make_dataset_maps
+    train_num = int(0.9 * len(dataset))
+    eval_num = len(dataset) - train_num
+    train_dataset, eval_dataset = torch.utils.data.random_split(
+        dataset,
+        [train_num, eval_num],
+        generator=torch.Generator().manual_seed(123)
+    )
+    info = 'Deep{} refine with train: {}, eval: {}'.format(
+        maps_type, len(train_dataset), len(eval_dataset)
+    )
+    logger.info(info)
 
     train_loader = torch.utils.data.DataLoader(train_dataset,
                                                batch_size=batch_size,
                                                num_workers=num_workers,
                                                shuffle=True,
-                                               pin_memory=True,
-                                               collate_fn=my_collate)
+                                               pin_memory=True)
     eval_loader = torch.utils.data.DataLoader(eval_dataset,
                                               batch_size=batch_size,
                                               num_workers=num_workers,
                                               shuffle=False,
-                                              pin_memory=True,
-                                              collate_fn=my_collate)
+                                              pin_memory=True)
     # optimizer
     for param in model_maps.parameters():
         param.requires_grad = False
@@ -310,7 +390,7 @@ def retrain_model_map(model_maps, maps, valid_nums, labels, maps_type, epochs):
     loss_fn = torch.nn.CrossEntropyLoss()
 
     # acc before refine
-    acc = eval_one_epoch(eval_loader, model_maps)
+    acc = eval_one_epoch_head(eval_loader, model_maps)
     info = 'Deep{} before refine, acc is: {:.3f}'.format(maps_type, acc)
     logger.info(info)
 
@@ -318,10 +398,10 @@ def retrain_model_map(model_maps, maps, valid_nums, labels, maps_type, epochs):
     model_best = copy.deepcopy(model_maps)
     acc_best = 0.
     for i in range(epochs):
-        epoch_loss = train_one_epoch(
+        epoch_loss = train_one_epoch_head(
             train_loader, model_maps, optimizer, loss_fn
         )
-        acc = eval_one_epoch(eval_loader, model_maps)
+        acc = eval_one_epoch_head(eval_loader, model_maps)
         info = 'Deep{} refine epoch {}, loss: {:.3f}, acc: {:.3f}'.format(
             maps_type, i, epoch_loss, acc
         )
@@ -396,23 +476,165 @@ def train_model_mall(malls, valid_num, labels, epochs):
     return model_best
 
 
-def refine_models(df_top, ms, model_center, model_big):
+def eval_model(model, data, valid_nums, labels, train_ratio=0.9):
+    '''
+    Acc on the same eval split used by retrain_model_map/train_model_mall.
+    '''
+    if isinstance(model, models.DeepMall):
+        dataset = dataloader.Mall_Dataset(data, valid_nums, labels)
+    else:
+        dataset = dataloader.Map_Dataset(data, valid_nums, labels)
+    train_num = int(train_ratio * len(dataset))
+    eval_num = len(dataset) - train_num
+    _, eval = torch.utils.data.random_split(
+        dataset,
+        [train_num, eval_num],
+        generator=torch.Generator().manual_seed(123)
+    )
+    eval_loader = torch.utils.data.DataLoader(eval,
+                                              batch_size=64,
+                                              num_workers=0,
+                                              shuffle=False,
+                                              pin_memory=True,
+                                              collate_fn=my_collate)
+    return eval_one_epoch(eval_loader, model)
+
+
+def get_model_key(ms):
+    '''
+    Runs from the same instrument, gradient and window scheme share a key.
+    '''
+    device = ms.get_device_name().replace(' ', '_')
+    gradient = ms.get_scan_rts()[-1] / 60.
+    swath = np.round(ms.get_swath(), 1).astype(np.float64)
+    windows = hashlib.md5(swath.tobytes()).hexdigest()[:8]
+    return '{}_{:.0f}min_{}'.format(device, gradient, windows)
+
+
+def get_model_cache_dir(key):
+    if param_g.dir_model_cache is not None:
+        return Path(param_g.dir_model_cache) / key
+    if param_g.dir_out_global is not None:
+        return Path(param_g.dir_out_global) / 'models' / key
+    return None
+
+
+def load_cached_models(key, model_center, model_big, mall_dim):
+    '''
+    Returns:
+        None or ([model_center, model_big, model_mall], accs_when_cached)
+    '''
+    dir_key = get_model_cache_dir(key)
+    if (dir_key is None) or (not (dir_key / 'meta.json').exists()):
+        return None
+    with open(dir_key / 'meta.json', 'r') as f:
+        meta = json.load(f)
+    if meta['mall_dim'] != mall_dim:
+        return None
+
+    device = param_g.gpu_id
+    model_center = copy.deepcopy(model_center)
+    model_center.load_state_dict(
+        torch.load(dir_key / 'center.pt', map_location=device)
+    )
+    model_big = copy.deepcopy(model_big)
+    model_big.load_state_dict(
+        torch.load(dir_key / 'big.pt', map_location=device)
+    )
+    model_mall = models.DeepMall(input_dim=mall_dim,
+                                 feature_dim=32).to(device)
+    model_mall.load_state_dict(
+        torch.load(dir_key / 'mall.pt', map_location=device)
+    )
+    return [model_center, model_big, model_mall], meta['accs']
+
+
+def save_cached_models(key, model_center, model_big, model_mall, mall_dim,
+                       accs):
+    dir_key = get_model_cache_dir(key)
+    if dir_key is None:
+        return
+    dir_key.mkdir(parents=True, exist_ok=True)
+    torch.save(model_center.state_dict(), dir_key / 'center.pt')
+    torch.save(model_big.state_dict(), dir_key / 'big.pt')
+    torch.save(model_mall.state_dict(), dir_key / 'mall.pt')
+    ws_single = getattr(param_g, 'ws_single', None)
+    meta = {'key': key,
+            'mall_dim': mall_dim,
+            'accs': [float(acc) for acc in accs],
+            'ws': None if ws_single is None else ws_single.name}
+    with open(dir_key / 'meta.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    logger.info(f'Refined models are cached: {key}')
+
+
+def refine_models(df_top, ms, model_center, model_big, cohort=None):
     '''
     Refine/Train models by the first round identifications.
+    If models refined by a run with the same instrument, gradient and window
+    scheme are cached, they are reused when their acc on the eval set of this
+    run does not drop more than model_cache_acc_tol. Otherwise, full refine.
     Args:
         df_top: with FDR
         ms:
         model_center: deepprofile-14
         model_big: deepprofile-56
+        cohort: Cohort of the runs, None means param_g.cohort
 
     Returns:
         model_center, model_big, model_mall
     '''
+    if cohort is None:
+        cohort = param_g.cohort
+    if param_g.is_cohort_refine and cohort is not None:
+        return refine_models_cohort(df_top, ms, model_center, model_big,
+                                    cohort)
+
     logger.info('Extracting maps and malls to refine models...')
     maps_center, maps_big, malls, valid_nums, labels = extract_map_by_compare(
         df_top, ms)
     # logger.info('Refine models: end to extract maps and malls.')
+    data_v = [(maps_center, valid_nums),
+              (maps_big, 4 * valid_nums),
+              (malls, valid_nums - 3)]
+
+    # reuse the cached models by the acc gate
+    key = get_model_key(ms) if param_g.is_model_cache else None
+    cached = None
+    if key is not None:
+        cached = load_cached_models(key, model_center, model_big, malls.shape[1])
+    if cached is not None:
+        models_cached, accs_cached = cached
+        for model in models_cached:
+            model.eval()
+        accs = [eval_model(model, x, n, labels)
+                for model, (x, n) in zip(models_cached, data_v)]
+        acc_drop = max(a0 - a for a0, a in zip(accs_cached, accs))
+        info = 'Cached models {}, acc: {}, drop: {:.3f}'.format(
+            key, ', '.join(f'{acc:.3f}' for acc in accs), acc_drop
+        )
+        logger.info(info)
+        if acc_drop <= param_g.model_cache_acc_tol:
+            logger.info('Reusing cached models, skip refinement.')
+            return tuple(models_cached)
+        logger.info('Cached models fail the acc gate, refining from scratch.')
+
+    model_center, model_big, model_mall = train_models(
+        maps_center, maps_big, malls, valid_nums, labels,
+        model_center, model_big
+    )
+
+    if key is not None:
+        accs = [eval_model(model, x, n, labels) for model, (x, n) in
+                zip([model_center, model_big, model_mall], data_v)]
+        save_cached_models(key, model_center, model_big, model_mall,
+                           malls.shape[1], accs)
+
+    return model_center, model_big, model_mall
 
+
+def train_models(maps_center, maps_big, malls, valid_nums, labels,
+                 model_center, model_big):
     model_center = retrain_model_map(model_center,
                                      maps_center,
                                      valid_nums,
@@ -432,3 +654,72 @@ def refine_models(df_top, ms, model_center, model_big):
     model_mall.eval()
 
     return model_center, model_big, model_mall
+
+
+def sample_cohort(maps_center, maps_big, malls, valid_nums, labels):
+    '''
+    Sample at most cohort_sample_num of a run, half pos and half neg.
+    '''
+    n_half = int(param_g.cohort_sample_num / 2)
+    rng = np.random.default_rng(123)
+    idx_v = []
+    for label in [1, 0]:
+        idx = np.where(labels == label)[0]
+        if len(idx) > n_half:
+            idx = np.sort(rng.choice(idx, n_half, replace=False))
+        idx_v.append(idx)
+    idx = np.concatenate(idx_v)
+    return (maps_center[idx], maps_big[idx], malls[idx],
+            valid_nums[idx], labels[idx])
+
+
+class Cohort():
+    '''
+    State of the cohort refine shared by the runs of multi_ws: the pooled
+    samples of the finished runs and the models fixed for the rest runs.
+    '''
+    def __init__(self):
+        self.pool = []
+        self.models = None
+
+    def add(self, data):
+        self.pool.append(sample_cohort(*data))
+        return [np.concatenate(x) for x in zip(*self.pool)]
+
+    def fix(self, models_refined):
+        self.models = models_refined
+        self.pool.clear()
+
+
+def refine_models_cohort(df_top, ms, model_center, model_big, cohort):
+    '''
+    Cohort-level refine. Runs are processed one by one, so each run adds its
+    samples to the pool and the models are trained on the pool. Once the
+    pooled pos reaches cohort_pos_min (or the last run is pooled), the models
+    are fixed and shared by the rest runs without extraction and training.
+    Warm-up: the runs before the fix are scored by the models trained on the
+    pool so far, i.e. not by the fixed models. With the defaults, a run
+    reaching 10000 pos fixes the models by itself and only the runs before
+    it (fewer ids) are warm-up.
+    '''
+    if cohort.models is not None:
+        logger.info('Cohort refine: reusing the shared models.')
+        return cohort.models
+
+    logger.info('Extracting maps and malls to refine models...')
+    data = extract_map_by_compare(df_top, ms)
+    data = cohort.add(data)
+    labels = data[-1]
+    pos_num = int(labels.sum())
+    info = 'Cohort refine: pooled {} runs, pos: {}, neg: {}'.format(
+        len(cohort.pool), pos_num, len(labels) - pos_num
+    )
+    logger.info(info)
+
+    models_refined = train_models(*data, model_center, model_big)
+
+    is_last = len(cohort.pool) >= param_g.file_num
+    if pos_num >= param_g.cohort_pos_min or is_last:
+        cohort.fix(models_refined)
+        logger.info('Cohort refine: models are fixed for the rest runs.')
+    return models_refined
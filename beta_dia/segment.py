@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+from numba import jit, prange
+
+from beta_dia.log import Logger
+
+try:
+    # profile
+    profile = lambda x: x
+except:
+    profile = lambda x: x
+
+logger = Logger.get_logger()
+
+'''
+Segmented reductions over sorted group offsets. Rows of a group are
+contiguous and the group g is rows [offsets[g], offsets[g+1]).
+'''
+
+
+def get_offsets(keys):
+    '''
+    Offsets of the contiguous runs of keys, same as the cumsum of
+    groupby(keys, sort=False).size() when groups are contiguous.
+    '''
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    return np.concatenate([[0], starts, [len(keys)]]).astype(np.int64)
+
+
+def broadcast(values, offsets):
+    '''
+    Per-group values to per-row.
+    '''
+    return np.repeat(values, np.diff(offsets))
+
+
+@jit(nopython=True, nogil=True, parallel=True)
+def segment_max(x, offsets):
+    '''
+    NaN is skipped as groupby().max(), all NaN gives NaN.
+    '''
+    result = np.empty(len(offsets) - 1, dtype=x.dtype)
+    for g in prange(len(offsets) - 1):
+        v = x[offsets[g]]
+        for i in range(offsets[g] + 1, offsets[g + 1]):
+            if x[i] > v or np.isnan(v):
+                v = x[i]
+        result[g] = v
+    return result
+
+
+@jit(nopython=True, nogil=True, parallel=True)
+def segment_sum(x, offsets):
+    result = np.empty(len(offsets) - 1, dtype=x.dtype)
+    for g in prange(len(offsets) - 1):
+        v = x[offsets[g]]
+        for i in range(offsets[g] + 1, offsets[g + 1]):
+            v += x[i]
+        result[g] = v
+    return result
+
+
+@jit(nopython=True, nogil=True, parallel=True)
+def segment_rank(x, offsets):
+    '''
+    Descending rank in each group starting from 1, ties by row order.
+    Small groups count the betters without sort or allocation.
+    '''
+    rank = np.empty(len(x), dtype=np.uint8)
+    for g in prange(len(offsets) - 1):
+        start, end = offsets[g], offsets[g + 1]
+        if end - start > 64:
+            order = np.argsort(-x[start:end], kind='mergesort')
+            for r in range(end - start):
+                rank[start + order[r]] = r + 1
+            continue
+        for i in range(start, end):
+            r = 1
+            for j in range(start, end):
+                if x[j] > x[i] or (x[j] == x[i] and j < i):
+                    r += 1
+            rank[i] = r
+    return rank
+
+
+@jit(nopython=True, nogil=True)
+def code_argmax(codes, x, group_num):
+    '''
+    Row index of the first max of each group by codes (0, ..., group_num-1)
+    in one pass, rows of a group need not be contiguous. NaN is skipped.
+    '''
+    result = np.full(group_num, -1, dtype=np.int64)
+    for i in range(len(codes)):
+        g = codes[i]
+        if np.isnan(x[i]):
+            if result[g] == -1:
+                result[g] = i
+            continue
+        j = result[g]
+        if j == -1 or np.isnan(x[j]) or x[i] > x[j]:
+            result[g] = i
+    return result
+
+
+def group_argmax(keys, x):
+    '''
+    Positions of the max rows of groups by keys. Groups are in the sorted
+    order of keys and the first max is taken, same as the positions of
+    df.groupby(keys)[x].idxmax().
+    '''
+    codes, uniques = pd.factorize(np.asarray(keys))
+    idx = code_argmax(codes, np.asarray(x), len(uniques))
+    return idx[np.argsort(uniques, kind='stable')]
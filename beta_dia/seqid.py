@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+from numba import jit, prange
+
+from beta_dia.log import Logger
+
+try:
+    # profile
+    profile = lambda x: x
+except:
+    profile = lambda x: x
+
+logger = Logger.get_logger()
+
+'''
+Interned ids of prs by the content of pr_id, so groupbys and merges are on
+int64 keys instead of the str.replace of mods again and again:
+    seq_id: simple_seq, i.e. pr_id[:-1] with C(UniMod:4)/M(UniMod:35) as c/m
+    strip_id: strip_seq, i.e. simple_seq.upper()
+    il_id: pr_id with I/L collapsed
+Ids are 64-bit FNV-1a hashes, the same seq has the same id for targets,
+decoys and runs without a shared table. Ids are for equality only, their
+order is not the order of seqs.
+Ids are assumed collision-free. Two distinct seqs would share an id with
+the birthday bound n^2 / 2^65 for n distinct seqs, i.e. ~3e-8 for 1e6 and
+~3e-6 for 1e7 seqs, and a collision merges the two seqs in the groupbys
+(best pr of il_id, peptides of protein groups). The strings are built
+only where they are output, see get_seqs.
+'''
+
+cols_id = ['seq_id', 'strip_id', 'il_id']
+
+mod_c = np.frombuffer(b'C(UniMod:4)', dtype=np.uint8)
+mod_m = np.frombuffer(b'M(UniMod:35)', dtype=np.uint8)
+
+
+def encode_seqs(seqs):
+    '''
+    Seqs to uint8 residue codes (ascii) and offsets, the seq k is
+    codes[offsets[k]:offsets[k + 1]].
+    '''
+    seq_len = seqs.str.len().values
+    offsets = np.zeros(len(seq_len) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(seq_len)
+    codes = np.frombuffer(seqs.str.cat().encode('ascii'), dtype=np.uint8)
+    return codes, offsets
+
+
+def decode_seqs(codes, offsets):
+    lens = np.diff(offsets)
+    width = max(int(lens.max()) if len(lens) else 0, 1)
+    x = np.zeros((len(lens), width), dtype=np.uint8)
+    x[np.arange(width) < lens[:, None]] = codes
+    x = pd.Series(x.view('S' + str(width))[:, 0].tolist(), dtype=object)
+    return x.str.decode('ascii')
+
+
+@jit(nopython=True, nogil=True)
+def is_token_at(codes, i, end, token):
+    if i + len(token) > end:
+        return False
+    for j in range(len(token)):
+        if codes[i + j] != token[j]:
+            return False
+    return True
+
+
+@jit(nopython=True, nogil=True, parallel=True)
+def hash_pr_ids(codes, offsets, mod_c, mod_m):
+    n = len(offsets) - 1
+    basis = np.uint64(14695981039346656037)
+    prime = np.uint64(1099511628211)
+    seq_ids = np.empty(n, dtype=np.uint64)
+    strip_ids = np.empty(n, dtype=np.uint64)
+    il_ids = np.empty(n, dtype=np.uint64)
+    for k in prange(n):
+        start, end = offsets[k], offsets[k + 1]
+
+        # pr_id with I/L as x
+        h = basis
+        for i in range(start, end):
+            c = codes[i]
+            if c == 73 or c == 76:  # I, L
+                c = 120
+            h = (h ^ np.uint64(c)) * prime
+        il_ids[k] = h
+
+        # the last char is the charge
+        h_seq, h_strip = basis, basis
+        i = start
+        while i < end - 1:
+            c = codes[i]
+            step = 1
+            if c == 67 and is_token_at(codes, i, end - 1, mod_c):
+                c, step = 99, len(mod_c)  # c
+            elif c == 77 and is_token_at(codes, i, end - 1, mod_m):
+                c, step = 109, len(mod_m)  # m
+            h_seq = (h_seq ^ np.uint64(c)) * prime
+            if 97 <= c <= 122:
+                c -= 32
+            h_strip = (h_strip ^ np.uint64(c)) * prime
+            i += step
+        seq_ids[k] = h_seq
+        strip_ids[k] = h_strip
+    return seq_ids.view(np.int64), strip_ids.view(np.int64), \
+           il_ids.view(np.int64)
+
+
+@jit(nopython=True, nogil=True)
+def simplify_codes(codes, offsets, mod_c, mod_m):
+    '''
+    pr_id codes to simple_seq codes: the charge is dropped and
+    C(UniMod:4)/M(UniMod:35) are c/m, as hashed by hash_pr_ids.
+    '''
+    n = len(offsets) - 1
+    codes_new = np.empty(len(codes), dtype=np.uint8)
+    offsets_new = np.zeros(n + 1, dtype=np.int64)
+    j = 0
+    for k in range(n):
+        i, end = offsets[k], offsets[k + 1] - 1
+        while i < end:
+            c = codes[i]
+            step = 1
+            if c == 67 and is_token_at(codes, i, end, mod_c):
+                c, step = 99, len(mod_c)  # c
+            elif c == 77 and is_token_at(codes, i, end, mod_m):
+                c, step = 109, len(mod_m)  # m
+            codes_new[j] = c
+            j += 1
+            i += step
+        offsets_new[k + 1] = j
+    return codes_new[:j], offsets_new
+
+
+def get_seqs(pr_ids):
+    '''
+    simple_seq and strip_seq of pr_ids by residue codes, no regex.
+    '''
+    codes, offsets = encode_seqs(pd.Series(pr_ids))
+    codes, offsets = simplify_codes(codes, offsets, mod_c, mod_m)
+    simple_seq = decode_seqs(codes, offsets).values
+    is_lower = (codes >= 97) & (codes <= 122)
+    codes = np.where(is_lower, codes - 32, codes).astype(np.uint8)
+    strip_seq = decode_seqs(codes, offsets).values
+    return simple_seq, strip_seq
+
+
+def cal_seq_ids(pr_ids):
+    '''
+    Returns:
+        dict of cols_id -> int64 ids
+    '''
+    pr_ids = pd.Series(pr_ids)
+    codes, offsets = encode_seqs(pr_ids)
+    ids = hash_pr_ids(codes, offsets, mod_c, mod_m)
+    return dict(zip(cols_id, ids))
+
+
+def add_seq_ids(df, is_overwrite=False):
+    '''
+    Ids are calculated if any is not there or not complete (not int64).
+    '''
+    if is_overwrite or any(col not in df.columns or df[col].dtype != np.int64
+                           for col in cols_id):
+        for col, ids in cal_seq_ids(df['pr_id']).items():
+            df[col] = ids
+    return df
+
+
+def get_seq_ids(df, col):
+    '''
+    The ids of a col_id. Calculated from pr_id if the col is not there or
+    not complete (e.g. NaN after concat with dfs without ids).
+    '''
+    if col in df.columns and df[col].dtype == np.int64:
+        return df[col].values
+    return cal_seq_ids(df['pr_id'])[col]
@@ -0,0 +1,116 @@
+import glob
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from beta_dia import param_g
+from beta_dia.log import Logger
+
+try:
+    # profile
+    profile = lambda x: x
+except:
+    profile = lambda x: x
+
+logger = Logger.get_logger()
+
+cols_spill_start = 'score_ft_' # deep features, only read by FDR
+col_row_start = 'spill_row_'
+row_group_rows = 16384
+
+
+def get_spill_dir(key):
+    return Path(param_g.dir_out_global) / 'spill' / key
+
+
+class ScoreSpill():
+    '''
+    Spill the FDR-only scores (deep features) of each swath to a parquet file
+    and keep the rest in RAM. The column spill_row_<key> of df addresses the
+    spilled rows, so FDR reads the spilled columns of any rows back by row
+    groups and chunk by chunk, see features.get_score_matrix.
+    '''
+    def __init__(self, name):
+        ws_single = getattr(param_g, 'ws_single', None)
+        ws_name = 'run' if ws_single is None else ws_single.name
+        self.key = f'{ws_name}_{param_g.phase}_{name}'
+        self.col_row = col_row_start + self.key
+        self.dir = get_spill_dir(self.key)
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.dir.mkdir(parents=True)
+        self.part_num = 0
+        self.row_num = 0
+
+    def write(self, df_v):
+        '''
+        Returns:
+            the batches concat without the spilled columns
+        '''
+        df = pd.concat(df_v, axis=0, ignore_index=True)
+        cols = df.columns[df.columns.str.startswith(cols_spill_start)]
+        fname = self.dir / 'part_{}.parquet'.format(self.part_num)
+        df[cols].to_parquet(fname, index=False, row_group_size=row_group_rows)
+        self.part_num += 1
+
+        df = df.drop(columns=cols)
+        df[self.col_row] = np.arange(self.row_num, self.row_num + len(df))
+        self.row_num += len(df)
+        return df
+
+
+class SpillReader():
+    '''
+    Random access to the rows of a spill by its column spill_row_<key>.
+    '''
+    def __init__(self, col_row):
+        self.col_row = col_row
+        key = col_row[len(col_row_start):]
+        files = sorted(get_spill_dir(key).glob('part_*.parquet'),
+                       key=lambda x: int(x.stem.split('_')[1]))
+        self.pfs = [pq.ParquetFile(f) for f in files]
+        self.cols = self.pfs[0].schema_arrow.names
+
+        # global start row of each row group
+        self.groups = [(pf, i) for pf in self.pfs
+                       for i in range(pf.num_row_groups)]
+        sizes = [pf.metadata.row_group(i).num_rows for pf, i in self.groups]
+        self.starts = np.concatenate([[0], np.cumsum(sizes)])
+
+    def take(self, rows, cols):
+        '''
+        Rows of the spilled cols as a float32 matrix. Only the row groups
+        holding the rows are read and only the cols are decoded.
+        '''
+        X = np.empty((len(rows), len(cols)), dtype=np.float32)
+        groups = np.searchsorted(self.starts, rows, side='right') - 1
+        order = np.argsort(groups, kind='stable')
+        groups_sorted = groups[order]
+        bounds = np.flatnonzero(np.diff(groups_sorted)) + 1
+        for idx in np.split(order, bounds):
+            if len(idx) == 0:
+                continue
+            g = groups[idx[0]]
+            pf, i = self.groups[g]
+            table = pf.read_row_group(i, columns=cols)
+            table = table.take(rows[idx] - self.starts[g])
+            for j, col in enumerate(table.columns):
+                X[idx, j] = col.to_numpy()
+        return X
+
+
+def get_spill_readers(df):
+    return [SpillReader(col) for col in df.columns
+            if col.startswith(col_row_start)]
+
+
+def clear_spills(ws_name, phase):
+    '''
+    Spills of a run in a phase are consumed by its FDR, removed when the run
+    is saved.
+    '''
+    dir_spill = Path(param_g.dir_out_global) / 'spill'
+    for dir_key in dir_spill.glob(glob.escape(f'{ws_name}_{phase}_') + '*'):
+        shutil.rmtree(dir_key, ignore_errors=True)
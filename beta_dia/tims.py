@@ -169,6 +169,27 @@ def numba_paral_centroid(
     return all_height_summed, all_height_suppressed
 
 
+@jit(nopython=True, nogil=True, parallel=True)
+def numba_apply_mz_lut(mzs, lut, mz_start, step):
+    '''
+    m/z + correction, the correction is linear between the knots of the lut
+    and is the end knot out of the range.
+    '''
+    result = np.empty(len(mzs), dtype=np.float32)
+    for i in prange(len(mzs)):
+        x = (mzs[i] - mz_start) / step
+        if x <= 0.:
+            delta = lut[0]
+        elif x >= len(lut) - 1:
+            delta = lut[-1]
+        else:
+            k = int(x)
+            w = x - k
+            delta = lut[k] * (1. - w) + lut[k + 1] * w
+        result[i] = mzs[i] + delta
+    return result
+
+
 def load_ms(ws):
     ms = Tims(ws)
     device = ms.get_device_name()
@@ -199,6 +220,7 @@ class Tims():
 
         self.d_ms1_maps = d_ms1_maps
         self.d_ms2_maps = d_ms2_maps
+        self.mz_lut = None
 
         # logger.info('Loading .d data finished.')
 
@@ -386,6 +408,36 @@ class Tims():
                 cycle_valid_lens2, all_push2, all_tof2, all_height2,
                 )
 
+    def set_mz_correction(self, f, step=0.01):
+        '''
+        m/z calib f as a table of corrections f(x) - x at knots every step Da
+        over the m/z range of all maps. The maps are kept raw, and the table
+        is applied to a swath when it is copied to GPU. A later f is on the
+        calibrated m/z, so it is composed with the current table.
+        '''
+        if self.mz_lut is not None:
+            lut, mz_start, step = self.mz_lut
+            knots = mz_start + step * np.arange(len(lut))
+            self.mz_lut = (f(knots + lut) - knots, mz_start, step)
+            return
+
+        mz_min, mz_max = np.inf, -np.inf
+        for ms_map in list(self.d_ms1_maps.values()) + \
+                      list(self.d_ms2_maps.values()):
+            for mzs in [ms_map[3], ms_map[7]]:
+                if len(mzs):
+                    mz_min = min(mz_min, mzs.min())
+                    mz_max = max(mz_max, mzs.max())
+        mz_min, mz_max = float(mz_min), float(mz_max)
+        knots = np.arange(mz_min, mz_max + step, step)
+        self.mz_lut = (f(knots) - knots, mz_min, step)
+
+    def calib_mz(self, mzs):
+        if self.mz_lut is None:
+            return mzs
+        lut, mz_start, step = self.mz_lut
+        return numba_apply_mz_lut(mzs, lut, mz_start, step)
+
     def get_rt_range(self):
         all_rt = self.d_ms1_maps[1][0]
         return (all_rt.min(), all_rt.max())
@@ -418,7 +470,7 @@ class Tims():
                 )
                 scan_seek_idx = cuda.to_device(scan_seek_idx)
                 scan_im = cuda.to_device(all_push2)
-                scan_mz = cuda.to_device(all_tof2)
+                scan_mz = cuda.to_device(self.calib_mz(all_tof2))
                 scan_height = cuda.to_device(all_height2)
             else:
                 scan_seek_idx = np.concatenate(
@@ -426,7 +478,7 @@ class Tims():
                 )
                 scan_seek_idx = cuda.to_device(scan_seek_idx)
                 scan_im = cuda.to_device(all_push)
-                scan_mz = cuda.to_device(all_tof)
+                scan_mz = cuda.to_device(self.calib_mz(all_tof))
                 scan_height = cuda.to_device(all_height)
 
             dia_map = {
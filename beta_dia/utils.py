@@ -14,6 +14,8 @@ import torch
 from numba import cuda, jit, prange
 
 from beta_dia import param_g
+from beta_dia import segment
+from beta_dia import spill
 from beta_dia.log import Logger
 from beta_dia import __version__
 
@@ -52,6 +54,34 @@ def create_cuda_zeros(shape, dtype=torch.float32):
     return x
 
 
+def cal_fg_mz_iso_m(fg_mz_m, fg_charge_m, neutron_num):
+    '''
+    Fragment isotope m/z by shifting the center, O(1) per ion. 0 is kept
+    for the empty fragments.
+    '''
+    mass_neutron = 1.0033548378
+    x = (fg_mz_m * fg_charge_m + neutron_num * mass_neutron) / fg_charge_m
+    x[fg_mz_m <= 0.] = 0.
+    return x.astype(np.float32)
+
+
+def get_fg_mz_iso(df, neutron_num):
+    '''
+    Fragment m/z of neutron_num: -1 (left), 0 (center), 1 (1H) or 2 (2H).
+    Read from the columns if they are materialized, else generated.
+    '''
+    cols_center = ['fg_mz_' + str(i) for i in range(param_g.fg_num)]
+    if neutron_num == 0:
+        return df[cols_center].values
+    name = {-1: 'fg_mz_left_', 1: 'fg_mz_1H_', 2: 'fg_mz_2H_'}[neutron_num]
+    cols = [name + str(i) for i in range(param_g.fg_num)]
+    if cols[0] in df.columns:
+        return df[cols].values
+    cols_anno = ['fg_anno_' + str(i) for i in range(param_g.fg_num)]
+    fg_charge_m = df[cols_anno].values % 10
+    return cal_fg_mz_iso_m(df[cols_center].values, fg_charge_m, neutron_num)
+
+
 def get_diann_info(path_ws):
     if not param_g.is_compare_mode:
         return
@@ -198,6 +228,9 @@ def save_as_pkl(df, fname):
 
 
 def save_or_clean(df_main, df_other, ws_single, phase):
+    # scores are done, the spilled deep features are not needed
+    spill.clear_spills(ws_single.name, phase)
+
     cols_base = ['pr_id', 'pr_charge', 'pr_index',
             'swath_id', 'decoy', 'locus',
             'measure_rt', 'measure_im'
@@ -238,16 +271,8 @@ def read_from_pq(ws_single, cols=None):
     return df
 
 
-@jit(nopython=True, nogil=True, parallel=True)
 def cal_group_rank(x, group_size_cumsum):
-    item_num = len(x)
-    rank = np.zeros(item_num, dtype=np.uint8)
-    for i in prange(len(group_size_cumsum) - 1):
-        start = group_size_cumsum[i]
-        end = group_size_cumsum[i + 1]
-        xx = x[start: end]
-        rank[start : end] = np.argsort(np.argsort(-xx)) + 1
-    return rank
+    return segment.segment_rank(x, group_size_cumsum)
 
 
 def push_all_zeros_back(a):
@@ -454,6 +479,9 @@ def init_multi_ws(ws_global, out_name):
                 multi_ws.append(ws_i)
     param_g.multi_ws = multi_ws
     param_g.file_num = len(param_g.multi_ws)
+    if param_g.is_cohort_refine and param_g.file_num > 1:
+        from beta_dia import refine
+        param_g.cohort = refine.Cohort()
 
     info = 'The number of .d files contained in specified ws is less than 2!'
     if param_g.file_num < 2: